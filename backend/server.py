@@ -1,9 +1,11 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Depends, Request
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Depends, Header, Request, Query
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from passlib.context import CryptContext
 from jose import jwt, JWTError
 import os
@@ -12,13 +14,20 @@ import logging
 import time
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Dict, List, Literal, Optional
 import uuid
+import unicodedata
 from datetime import datetime, timezone, timedelta
+from zoneinfo import ZoneInfo
 from collections import defaultdict
+from contextlib import asynccontextmanager
 import io
+import asyncio
+import numpy as np
 import pandas as pd
+from openpyxl import load_workbook
 import json
+import base64
 import google.generativeai as genai
 
 ROOT_DIR = Path(__file__).parent
@@ -67,6 +76,9 @@ PRICE_LEVELS = ["Luxus", "Teuer", "Mittel", "Günstig"]
 CONDITIONS = ["Neu", "Kaum benutzt", "Gebraucht/Gut", "Abgenutzt"]
 RELEVANCE_LEVELS = ["Stark relevant", "Wichtig", "Nicht beliebt"]
 
+# Calendar days in statistics are the shop's days, not UTC days
+SHOP_TIMEZONE = "Europe/Zurich"
+
 # ============== Models ==============
 
 class PurchaseItem(BaseModel):
@@ -91,6 +103,28 @@ class PriceMatrixEntry(BaseModel):
     relevance: str
     fixed_price: Optional[float] = None
 
+class PriceLookupKey(BaseModel):
+    category: str
+    price_level: str
+    condition: str
+    relevance: str
+
+class PriceLookupBatch(BaseModel):
+    items: List[PriceLookupKey] = Field(..., max_length=1000)
+
+class PriceAdjustment(BaseModel):
+    multiplier: float = Field(1.0, ge=0)
+    offset: float = 0.0
+
+class PricingRules(BaseModel):
+    class Config:
+        extra = "forbid"
+    base_prices: Dict[str, float] = {}  # category -> base price in CHF
+    price_levels: Dict[str, PriceAdjustment] = {}
+    conditions: Dict[str, PriceAdjustment] = {}
+    relevance_levels: Dict[str, PriceAdjustment] = {}
+    rounding: float = Field(0.5, ge=0)  # Round computed prices to this step (slider uses 0.50 CHF)
+
 class Purchase(BaseModel):
     class Config:
         extra = "ignore"
@@ -114,6 +148,21 @@ class PurchaseResponse(BaseModel):
     credit_customer_id: Optional[str] = None
     credit_customer_name: Optional[str] = None
 
+class PurchaseSummary(BaseModel):
+    id: str
+    total: float
+    timestamp: str
+    item_count: int
+    items: Optional[List[PurchaseItem]] = None
+    staff_username: Optional[str] = None
+    credit_customer_id: Optional[str] = None
+    credit_customer_name: Optional[str] = None
+
+class PurchasePage(BaseModel):
+    purchases: List[PurchaseSummary]
+    next_cursor: Optional[str] = None
+    total_count: Optional[int] = None  # first page only
+
 class DailyStats(BaseModel):
     date: str
     count: int
@@ -153,6 +202,17 @@ class CustomerResponse(BaseModel):
     current_balance: float
     created_at: str
 
+class CustomerListItem(BaseModel):
+    id: str
+    first_name: str
+    last_name: str
+    email: str
+    current_balance: float
+
+class CustomerPage(BaseModel):
+    customers: List[CustomerListItem]
+    next_cursor: Optional[str] = None
+
 class TransactionCreate(BaseModel):
     amount: float
     type: str  # "credit" or "debit"
@@ -352,6 +412,271 @@ async def get_categories():
         "relevance_levels": RELEVANCE_LEVELS
     }
 
+# ============== Price Matrix Cache ==============
+
+class PriceMatrixCache:
+    """Dense in-memory copy of the price matrix.
+
+    Prices are held in float arrays indexed by the ordinal of each axis value
+    (categories × PRICE_LEVELS × CONDITIONS × RELEVANCE_LEVELS), NaN marks a cell
+    without a price. `fixed` holds the explicit price_matrix cells, `prices` the
+    effective prices: explicit cells take precedence over the pricing rules grid.
+    Instances are read-only: a reload builds a new cache and swaps the
+    module-level reference, so readers never see a half-built matrix.
+    """
+
+    def __init__(self, categories: List[str], entries: List[dict], version: int = 0, rules: Optional[dict] = None):
+        self.version = version
+        self.categories = list(categories)
+        self.axes = (self.categories, PRICE_LEVELS, CONDITIONS, RELEVANCE_LEVELS)
+        self._axis_index = tuple({label: i for i, label in enumerate(axis)} for axis in self.axes)
+        self.fixed = np.full(tuple(len(axis) for axis in self.axes), np.nan)
+        for e in entries:
+            pos = self.position(e.get("category"), e.get("price_level"), e.get("condition"), e.get("relevance"))
+            if pos is not None and e.get("fixed_price") is not None:
+                self.fixed[pos] = float(e["fixed_price"])
+        if rules:
+            self.prices = np.where(np.isnan(self.fixed), materialize_pricing_rules(rules, self.categories), self.fixed)
+        else:
+            self.prices = self.fixed.copy()
+        self.fixed.flags.writeable = False
+        self.prices.flags.writeable = False
+
+    def position(self, category: str, price_level: str, condition: str, relevance: str) -> Optional[tuple]:
+        """Array index of a cell, or None if any axis value is unknown."""
+        try:
+            return (
+                self._axis_index[0][category],
+                self._axis_index[1][price_level],
+                self._axis_index[2][condition],
+                self._axis_index[3][relevance],
+            )
+        except KeyError:
+            return None
+
+    def fixed_prices_for(self, cells: pd.DataFrame) -> np.ndarray:
+        """Explicit prices for a frame of cells keyed by MATRIX_KEY_FIELDS; all axis values must be known."""
+        positions = tuple(
+            cells[field].map(index).to_numpy(dtype=int)
+            for field, index in zip(MATRIX_KEY_FIELDS, self._axis_index)
+        )
+        return self.fixed[positions]
+
+    def lookup(self, category: str, price_level: str, condition: str, relevance: str) -> Optional[float]:
+        pos = self.position(category, price_level, condition, relevance)
+        if pos is None:
+            return None
+        value = self.prices[pos]
+        return None if np.isnan(value) else float(value)
+
+    def priced_cells(self) -> List[dict]:
+        """Every cell with an effective price, as price_matrix-shaped entries."""
+        return [
+            {
+                **{field: axis[i] for field, axis, i in zip(MATRIX_KEY_FIELDS, self.axes, pos)},
+                "fixed_price": float(self.prices[tuple(pos)])
+            }
+            for pos in np.argwhere(~np.isnan(self.prices))
+        ]
+
+
+MATRIX_KEY_FIELDS = ("category", "price_level", "condition", "relevance")
+
+def materialize_pricing_rules(rules: dict, categories: List[str]) -> np.ndarray:
+    """Compute the full rule-based grid in one vectorized pass.
+
+    price = base[category] × Π multipliers + Σ offsets over price level, condition
+    and relevance, rounded to `rounding` CHF and never negative. Categories without
+    a base price stay NaN.
+    """
+    def adjustments(axis: List[str], key: str):
+        configured = rules.get(key) or {}
+        multipliers = np.array([configured.get(v, {}).get("multiplier", 1.0) for v in axis], dtype=float)
+        offsets = np.array([configured.get(v, {}).get("offset", 0.0) for v in axis], dtype=float)
+        return multipliers, offsets
+
+    base_prices = rules.get("base_prices") or {}
+    base = np.array([base_prices.get(c, np.nan) for c in categories], dtype=float)
+    level_m, level_o = adjustments(PRICE_LEVELS, "price_levels")
+    condition_m, condition_o = adjustments(CONDITIONS, "conditions")
+    relevance_m, relevance_o = adjustments(RELEVANCE_LEVELS, "relevance_levels")
+
+    grid = (
+        base[:, None, None, None]
+        * level_m[None, :, None, None] * condition_m[None, None, :, None] * relevance_m[None, None, None, :]
+        + level_o[None, :, None, None] + condition_o[None, None, :, None] + relevance_o[None, None, None, :]
+    )
+    rounding = rules.get("rounding") or 0
+    if rounding > 0:
+        grid = np.round(grid / rounding) * rounding
+    return np.maximum(grid, 0)
+
+price_matrix_cache: Optional[PriceMatrixCache] = None
+price_matrix_cache_lock = asyncio.Lock()
+
+async def get_all_categories() -> List[str]:
+    """Standard categories followed by custom categories, in display order."""
+    custom_cats = await db.custom_categories.find({}, {"_id": 0, "name": 1}).to_list(100)
+    return CATEGORIES + [c["name"] for c in custom_cats if c.get("name")]
+
+async def get_price_matrix_state() -> dict:
+    """The app_settings document tracking the matrix version (and the versions of the last clear and rules change)."""
+    doc = await db.app_settings.find_one({"type": "price_matrix"}, {"_id": 0})
+    return doc or {"type": "price_matrix", "version": 0}
+
+async def _load_price_matrix_cache() -> PriceMatrixCache:
+    # Caller must hold price_matrix_cache_lock
+    global price_matrix_cache
+    version = (await get_price_matrix_state()).get("version", 0)
+    categories = await get_all_categories()
+    entries = await db.price_matrix.find({}, {"_id": 0}).to_list(None)
+    rules = await db.pricing_rules.find_one({"id": "default"}, {"_id": 0})
+    price_matrix_cache = PriceMatrixCache(categories, entries, version, rules)
+    logger.info(f"Price matrix cache loaded: version {version}, {len(entries)} entries, {len(categories)} categories")
+    return price_matrix_cache
+
+async def reload_price_matrix_cache() -> PriceMatrixCache:
+    """Rebuild the cache from MongoDB."""
+    # Serialize reloads so a slow, older reload can never overwrite a newer one
+    async with price_matrix_cache_lock:
+        return await _load_price_matrix_cache()
+
+@asynccontextmanager
+async def price_matrix_update(base_version: Optional[int] = None):
+    """Wrap every write to price_matrix or custom_categories.
+
+    Bumps the matrix version (monotonic, stored in app_settings so it survives
+    restarts) and yields it, so writers can stamp changed cells with it. The cache
+    is reloaded afterwards; holding the cache lock throughout means no reader can
+    observe the new version before the write is complete.
+
+    With base_version the write is refused (409) before the bump if the matrix
+    changed after that version, so a rejected write leaves the version untouched.
+    """
+    async with price_matrix_cache_lock:
+        if base_version is not None and (await get_price_matrix_state()).get("version", 0) != base_version:
+            raise HTTPException(status_code=409, detail="Preismatrix wurde inzwischen geändert. Bitte Datei erneut prüfen.")
+        state = await db.app_settings.find_one_and_update(
+            {"type": "price_matrix"},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        try:
+            yield state["version"]
+        finally:
+            await _load_price_matrix_cache()
+
+async def get_price_matrix_cache() -> PriceMatrixCache:
+    if price_matrix_cache is None:
+        return await reload_price_matrix_cache()
+    return price_matrix_cache
+
+# ============== Price Suggestion Index ==============
+# Median and p25/p75 of prices actually paid per matrix cell, from purchase history.
+# Stored in price_suggestions (one document per cell, _id = the cell key) and held
+# in memory for lookups.
+
+price_suggestion_index: Dict[tuple, dict] = {}
+# Strong references to running background tasks, so they are not garbage collected
+background_tasks: set = set()
+
+def matrix_key(doc: dict) -> tuple:
+    return tuple(doc.get(field) for field in MATRIX_KEY_FIELDS)
+
+def price_suggestion_cell_filter(cell: dict, prefix: str = "") -> dict:
+    """Query for the items of one cell, counting items without relevance as "Wichtig" like the $group below."""
+    query = {f"{prefix}{field}": value for field, value in cell.items()}
+    if cell.get("relevance") == "Wichtig":
+        # null also matches a missing field
+        query[f"{prefix}relevance"] = {"$in": ["Wichtig", None]}
+    return query
+
+def price_suggestion_pipeline(cells: Optional[List[dict]] = None) -> List[dict]:
+    """Aggregate paid item prices per cell, optionally restricted to the given cells.
+
+    Uses $percentile/$median, which need MongoDB 7.0+ (Atlas default).
+    """
+    pipeline = [{"$match": {"deleted": {"$ne": True}}}]
+    if cells:
+        pipeline[0]["$match"]["items"] = {"$elemMatch": {"$or": [price_suggestion_cell_filter(c) for c in cells]}}
+    pipeline.append({"$unwind": "$items"})
+    if cells:
+        pipeline.append({"$match": {"$or": [price_suggestion_cell_filter(c, "items.") for c in cells]}})
+    pipeline += [
+        {"$group": {
+            "_id": {
+                "category": "$items.category",
+                "price_level": "$items.price_level",
+                "condition": "$items.condition",
+                # Items from before relevance existed default to "Wichtig", like PurchaseItem
+                "relevance": {"$ifNull": ["$items.relevance", "Wichtig"]}
+            },
+            "count": {"$sum": 1},
+            "median": {"$median": {"input": "$items.price", "method": "approximate"}},
+            "quartiles": {"$percentile": {"input": "$items.price", "p": [0.25, 0.75], "method": "approximate"}}
+        }},
+        {"$project": {
+            "category": "$_id.category",
+            "price_level": "$_id.price_level",
+            "condition": "$_id.condition",
+            "relevance": "$_id.relevance",
+            "count": 1,
+            "median": 1,
+            "p25": {"$arrayElemAt": ["$quartiles", 0]},
+            "p75": {"$arrayElemAt": ["$quartiles", 1]}
+        }}
+    ]
+    return pipeline
+
+def price_suggestion(doc: dict) -> dict:
+    return {"median": doc["median"], "p25": doc["p25"], "p75": doc["p75"], "count": doc["count"]}
+
+async def load_price_suggestions():
+    global price_suggestion_index
+    docs = await db.price_suggestions.find({}).to_list(None)
+    price_suggestion_index = {matrix_key(d): price_suggestion(d) for d in docs}
+
+async def rebuild_price_suggestions() -> int:
+    """Recompute every cell from the full purchase history and replace the collection."""
+    await db.purchases.aggregate(price_suggestion_pipeline() + [{"$out": "price_suggestions"}]).to_list(None)
+    await load_price_suggestions()
+    return len(price_suggestion_index)
+
+async def refresh_price_suggestions(cells: List[dict]):
+    """Recompute only the given cells; cells without remaining purchases are dropped."""
+    cells = [dict(zip(MATRIX_KEY_FIELDS, key)) for key in {matrix_key(c) for c in cells}]
+    docs = await db.purchases.aggregate(price_suggestion_pipeline(cells)).to_list(None)
+    found = {matrix_key(d): d for d in docs}
+    operations = []
+    for cell in cells:
+        key = matrix_key(cell)
+        if key in found:
+            operations.append(ReplaceOne({"_id": found[key]["_id"]}, found[key], upsert=True))
+            price_suggestion_index[key] = price_suggestion(found[key])
+        else:
+            operations.append(DeleteOne({"_id": cell}))
+            price_suggestion_index.pop(key, None)
+    await db.price_suggestions.bulk_write(operations, ordered=False)
+
+def run_in_background(coro, description: str):
+    """Run a coroutine without awaiting it; failures are logged, not raised."""
+    async def run():
+        try:
+            await coro
+        except Exception as e:
+            logger.error(f"{description} failed: {e}")
+
+    task = asyncio.create_task(run())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+def schedule_price_suggestion_refresh(items: List[dict]):
+    """Refresh the cells of these items in the background, off the checkout path."""
+    cells = [{field: item.get(field) for field in MATRIX_KEY_FIELDS} for item in items]
+    if cells:
+        run_in_background(refresh_price_suggestions(cells), "Price suggestion refresh")
+
 # ============== Price Matrix Routes ==============
 
 @api_router.get("/price-matrix/lookup")
@@ -362,155 +687,798 @@ async def lookup_fixed_price(
     relevance: str,
     current_user: dict = Depends(get_current_user)
 ):
-    entry = await db.price_matrix.find_one(
-        {
-            "category": category,
-            "price_level": price_level,
-            "condition": condition,
-            "relevance": relevance
-        },
-        {"_id": 0}
-    )
-    if entry and entry.get("fixed_price") is not None:
-        return {"fixed_price": entry["fixed_price"], "found": True}
-    return {"fixed_price": None, "found": False}
+    cache = await get_price_matrix_cache()
+    fixed_price = cache.lookup(category, price_level, condition, relevance)
+    if fixed_price is not None:
+        return {"fixed_price": fixed_price, "found": True}
+    # No fixed price: suggest from what was paid for this cell before
+    suggestion = price_suggestion_index.get((category, price_level, condition, relevance))
+    return {"fixed_price": None, "found": False, "suggestion": suggestion}
+
+@api_router.post("/price-matrix/lookup/batch")
+async def lookup_fixed_prices(data: PriceLookupBatch, current_user: dict = Depends(get_current_user)):
+    """Resolve many cells in one request. Results keep the order of the submitted items."""
+    cache = await get_price_matrix_cache()
+    results = []
+    for key in data.items:
+        fixed_price = cache.lookup(key.category, key.price_level, key.condition, key.relevance)
+        results.append({
+            **key.model_dump(),
+            "fixed_price": fixed_price,
+            "found": fixed_price is not None,
+            "suggestion": None if fixed_price is not None else price_suggestion_index.get(matrix_key(key.model_dump()))
+        })
+    return {"results": results}
 
-@api_router.get("/price-matrix/download")
-async def download_price_matrix(current_user: dict = Depends(get_current_user)):
-    existing = await db.price_matrix.find({}, {"_id": 0}).to_list(10000)
-    existing_map = {}
-    for e in existing:
-        key = f"{e['category']}|{e['price_level']}|{e['condition']}|{e['relevance']}"
-        existing_map[key] = e.get('fixed_price')
-    
-    # Get custom categories
-    custom_cats = await db.custom_categories.find({}, {"_id": 0}).to_list(100)
-    custom_cat_names = [c["name"] for c in custom_cats]
-    
-    # Combine all categories
-    all_categories = CATEGORIES + custom_cat_names
-    
-    rows = []
-    for cat in all_categories:
-        for level in PRICE_LEVELS:
-            for cond in CONDITIONS:
-                for rel in RELEVANCE_LEVELS:
-                    key = f"{cat}|{level}|{cond}|{rel}"
-                    rows.append({
-                        "Kategorie": cat,
-                        "Preisniveau": level,
-                        "Zustand": cond,
-                        "Relevanz": rel,
-                        "Fixpreis": existing_map.get(key, "")
-                    })
-    
-    df = pd.DataFrame(rows)
-    
-    # Security: Sanitize for Excel Injection
-    # Escape cells starting with =, +, -, @
-    def sanitize_excel_cell(value):
-        if isinstance(value, str) and value.startswith(('=', '+', '-', '@')):
-            return "'" + value
-        return value
+# Security: Sanitize for Excel Injection
+# Escape cells starting with =, +, -, @
+def sanitize_excel_cell(value):
+    if isinstance(value, str) and value.startswith(('=', '+', '-', '@')):
+        return "'" + value
+    return value
+
+def price_matrix_frame(cache: PriceMatrixCache) -> pd.DataFrame:
+    """The full grid in download layout, one row per cell in axis order.
 
+    Only explicit cells carry a Fixpreis, so re-uploading a download does not
+    freeze rule-based prices into overrides.
+    """
+    df = pd.MultiIndex.from_product(
+        cache.axes, names=["Kategorie", "Preisniveau", "Zustand", "Relevanz"]
+    ).to_frame(index=False)
+    # from_product iterates in the same (C) order as the flattened array
+    prices = cache.fixed.ravel()
+    df["Fixpreis"] = pd.Series(prices, dtype=object).where(~np.isnan(prices), "")
     # Apply to all string columns (object dtype)
     for col in df.select_dtypes(include=['object']).columns:
-        df[col] = df[col].apply(sanitize_excel_cell)
-        
+        df[col] = df[col].map(sanitize_excel_cell)
+    return df
+
+# Supported import/export formats: media type and download filename
+PRICE_MATRIX_FORMATS = {
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "preismatrix.xlsx"),
+    "csv": ("text/csv; charset=utf-8", "preismatrix.csv"),
+    "ndjson": ("application/x-ndjson", "preismatrix.ndjson"),
+}
+
+def render_price_matrix(cache: PriceMatrixCache, fmt: str) -> bytes:
+    """Blocking: call via asyncio.to_thread."""
+    df = price_matrix_frame(cache)
+    if fmt == "csv":
+        return df.to_csv(index=False).encode("utf-8")
+    if fmt == "ndjson":
+        df["Fixpreis"] = df["Fixpreis"].where(df["Fixpreis"] != "", None)
+        return df.to_json(orient="records", lines=True, force_ascii=False).encode("utf-8")
     output = io.BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
         df.to_excel(writer, index=False, sheet_name='Preismatrix')
-    output.seek(0)
+    return output.getvalue()
+
+def requested_price_matrix_format(explicit: Optional[str], content_type: Optional[str], filename: str = "") -> str:
+    """Resolve the format from a query parameter, then file extension, then media type. Default: xlsx."""
+    if explicit:
+        return explicit
+    filename = (filename or "").lower()
+    content_type = (content_type or "").lower()
+    if filename.endswith(".csv") or "text/csv" in content_type:
+        return "csv"
+    if filename.endswith((".ndjson", ".jsonl")) or "ndjson" in content_type:
+        return "ndjson"
+    return "xlsx"
+
+# Last rendered file per format as (version, bytes); replaced whenever the version moves on
+price_matrix_renders: dict = {}
+
+@api_router.get("/price-matrix/download")
+async def download_price_matrix(
+    request: Request,
+    format: Optional[Literal["xlsx", "csv", "ndjson"]] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    fmt = requested_price_matrix_format(format, request.headers.get("Accept"))
+    media_type, filename = PRICE_MATRIX_FORMATS[fmt]
+    cache = await get_price_matrix_cache()
+    etag = f'"preismatrix-v{cache.version}.{fmt}"'
+    # private/no-cache: browsers may keep the file but must revalidate with If-None-Match
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    rendered = price_matrix_renders.get(fmt)
+    if rendered is None or rendered[0] != cache.version:
+        rendered = (cache.version, await asyncio.to_thread(render_price_matrix, cache, fmt))
+        price_matrix_renders[fmt] = rendered
     
     return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment; filename=preismatrix.xlsx"}
+        io.BytesIO(rendered[1]),
+        media_type=media_type,
+        headers={**headers, "Content-Disposition": f"attachment; filename={filename}"}
     )
 
 @api_router.get("/price-matrix")
-async def get_price_matrix(current_user: dict = Depends(get_current_user)):
-    entries = await db.price_matrix.find({}, {"_id": 0}).to_list(10000)
-    return entries
+async def get_price_matrix(
+    since: Optional[int] = None,
+    format: Literal["entries", "compact"] = "entries",
+    current_user: dict = Depends(get_current_user)
+):
+    """All entries, or with `since=<version>` only the cells changed after that version.
+
+    With `format=compact` the full grid is returned as axis label lists plus one
+    flat price array in axis order (category, price level, condition, relevance;
+    null = no fixed price), so cell (c, l, k, r) is at
+    ((c * len(price_levels) + l) * len(conditions) + k) * len(relevance_levels) + r.
+
+    Without `since` the explicit price_matrix entries are listed (for editing). The
+    delta response, like `compact` and the lookups, carries effective prices: explicit
+    cells over the pricing rules. It holds the new version to pass as `since` next
+    time. If the matrix was cleared or the pricing rules changed after `since` (or
+    since is 0), `reset` is true and `changed` holds every priced cell: drop the local
+    copy before applying it. Cells left without any price are listed under `removed`.
+    """
+    if format == "compact":
+        cache = await get_price_matrix_cache()
+        flat = cache.prices.ravel()
+        return {
+            "version": cache.version,
+            "axes": {
+                "categories": cache.categories,
+                "price_levels": PRICE_LEVELS,
+                "conditions": CONDITIONS,
+                "relevance_levels": RELEVANCE_LEVELS
+            },
+            "prices": np.where(np.isnan(flat), None, flat).tolist()
+        }
+
+    if since is None:
+        entries = await db.price_matrix.find({}, {"_id": 0}).to_list(10000)
+        return entries
+
+    cache = await get_price_matrix_cache()
+    state = await get_price_matrix_state()
+    # A rules change reprices cells without touching their documents, so it needs a full resync too
+    reset = (
+        since <= 0 or since > cache.version
+        or since < state.get("cleared_version", 0) or since < state.get("rules_version", 0)
+    )
+    changed, removed = [], []
+    if reset:
+        changed = cache.priced_cells()
+    else:
+        entries = await db.price_matrix.find(
+            {"version": {"$gt": since}}, {"_id": 0, "category": 1, "price_level": 1, "condition": 1, "relevance": 1}
+        ).to_list(None)
+        for e in entries:
+            key = {field: e[field] for field in MATRIX_KEY_FIELDS}
+            # A removed explicit price may fall back to a rule price
+            price = cache.lookup(*key.values())
+            if price is None:
+                removed.append(key)
+            else:
+                changed.append({**key, "fixed_price": price})
+    return {
+        "version": cache.version,
+        "categories": cache.categories,
+        "reset": reset,
+        "changed": changed,
+        "removed": removed
+    }
+
+# Excel column -> price_matrix field
+PRICE_MATRIX_COLUMNS = {
+    "Kategorie": "category",
+    "Preisniveau": "price_level",
+    "Zustand": "condition",
+    "Relevanz": "relevance",
+    "Fixpreis": "fixed_price",
+}
+MAX_REJECTED_ROWS_REPORTED = 100
+
+def validate_price_matrix_frame(df: pd.DataFrame, categories: List[str]):
+    """Validate an uploaded sheet column-wise against the allowed axis values.
+
+    Returns (valid, rejected): a DataFrame of unique cells keyed by the price_matrix
+    fields (last row wins for duplicates) and a list of rejected rows with the
+    spreadsheet row number and reason.
+    """
+    missing = [col for col in PRICE_MATRIX_COLUMNS if col not in df.columns]
+    if missing:
+        raise HTTPException(status_code=400, detail="Excel muss Spalten: Kategorie, Preisniveau, Zustand, Relevanz, Fixpreis enthalten")
+
+    frame = pd.DataFrame({
+        field: df[col].astype("string").str.strip()
+        for col, field in PRICE_MATRIX_COLUMNS.items() if field != "fixed_price"
+    })
+    raw_price = df["Fixpreis"].astype("string").str.strip().replace("", pd.NA)
+    frame["fixed_price"] = pd.to_numeric(raw_price, errors="coerce")
+    # Spreadsheet row number: header is row 1
+    frame["row"] = df.index + 2
+
+    reasons = pd.Series(pd.NA, index=frame.index, dtype="object")
+    allowed = {
+        "category": ("Kategorie", categories),
+        "price_level": ("Preisniveau", PRICE_LEVELS),
+        "condition": ("Zustand", CONDITIONS),
+        "relevance": ("Relevanz", RELEVANCE_LEVELS),
+    }
+    for field, (label, values) in allowed.items():
+        invalid = ~frame[field].isin(values).fillna(False).astype(bool) & reasons.isna()
+        reasons[invalid] = f"Ungültiger Wert für {label}"
+    bad_price = raw_price.notna() & frame["fixed_price"].isna() & reasons.isna()
+    reasons[bad_price] = "Fixpreis ist keine Zahl"
+
+    rejected_mask = reasons.notna()
+    rejected = [
+        {"row": int(row), "reason": reason}
+        for row, reason in zip(frame.loc[rejected_mask, "row"], reasons[rejected_mask])
+    ]
+    valid = frame[~rejected_mask].drop_duplicates(subset=list(MATRIX_KEY_FIELDS), keep="last")
+    return valid, rejected
+
+def read_price_matrix_workbook(content: bytes) -> pd.DataFrame:
+    """Parse the first sheet of an uploaded workbook.
+
+    Blocking: call via asyncio.to_thread. Uses openpyxl's read-only mode, which
+    streams rows from the sheet XML instead of building the whole workbook in
+    memory, and keeps only the price matrix columns. The index is the zero-based
+    data row (like pd.read_excel) so rejected rows map back to the sheet.
+    """
+    workbook = load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        wanted = {
+            i: str(name).strip() for i, name in enumerate(header)
+            if name is not None and str(name).strip() in PRICE_MATRIX_COLUMNS
+        }
+        columns = {name: [] for name in wanted.values()}
+        positions = []
+        for position, row in enumerate(rows):
+            if all(value is None for value in row):
+                continue  # Skip blank lines
+            positions.append(position)
+            for i, name in wanted.items():
+                columns[name].append(row[i] if i < len(row) else None)
+        return pd.DataFrame(columns, index=positions)
+    finally:
+        workbook.close()
+
+def read_price_matrix_text(content: bytes, fmt: str) -> pd.DataFrame:
+    """Parse a CSV or NDJSON upload. Blocking: call via asyncio.to_thread."""
+    text = io.StringIO(content.decode("utf-8-sig"))
+    if fmt == "csv":
+        # Sniff the separator: Excel in de-CH writes semicolons
+        return pd.read_csv(text, sep=None, engine="python", dtype=str, keep_default_na=False)
+    records = [json.loads(line) for line in text if line.strip()]
+    return pd.DataFrame.from_records(records)
+
+def price_matrix_upserts(valid: pd.DataFrame, version: int) -> List[UpdateOne]:
+    """Upserts for validated cells. Only cells whose price actually changes get the new version."""
+    operations = []
+    for category, price_level, condition, relevance, fixed_price in zip(
+        valid["category"], valid["price_level"], valid["condition"], valid["relevance"], valid["fixed_price"]
+    ):
+        key = {"category": category, "price_level": price_level, "condition": condition, "relevance": relevance}
+        fixed_price = None if pd.isna(fixed_price) else float(fixed_price)
+        # Pipeline update: unchanged cells stay byte-identical, so they count as matched, not modified.
+        # Values are $literal, or a custom category such as "$Sale" would be read as a field path.
+        operations.append(UpdateOne(
+            key,
+            [{"$set": {
+                **{field: {"$literal": value} for field, value in key.items()},
+                "version": {"$cond": [{"$eq": ["$fixed_price", {"$literal": fixed_price}]}, "$version", version]},
+                "fixed_price": {"$literal": fixed_price}
+            }}],
+            upsert=True
+        ))
+    return operations
+
+def diff_price_matrix(cache: PriceMatrixCache, valid: pd.DataFrame) -> pd.DataFrame:
+    """Compare validated upload cells with the explicit cells of the cached matrix in one vectorized pass.
+
+    Returns the cells with old_price, new_price (NaN = no fixed price) and change:
+    "added", "changed", "removed" (price cleared) or "unchanged". Cells missing
+    from the upload are left alone by an upload, so they do not appear here.
+    """
+    old = cache.fixed_prices_for(valid)
+    new = valid["fixed_price"].to_numpy(dtype=float, na_value=np.nan)
+    has_old, has_new = ~np.isnan(old), ~np.isnan(new)
+    diff = valid[list(MATRIX_KEY_FIELDS)].copy()
+    diff["old_price"] = old
+    diff["new_price"] = new
+    diff["change"] = np.select(
+        [~has_old & has_new, has_old & ~has_new, has_old & has_new & (old != new)],
+        ["added", "removed", "changed"],
+        default="unchanged"
+    )
+    return diff
+
+def diff_records(diff: pd.DataFrame, change: str) -> List[dict]:
+    rows = diff.loc[diff["change"] == change, list(MATRIX_KEY_FIELDS) + ["old_price", "new_price"]]
+    return rows.astype(object).where(rows.notna(), None).to_dict("records")
+
+async def write_price_matrix_cells(cells: pd.DataFrame, base_version: Optional[int] = None) -> dict:
+    """Upsert cells with a single bulk_write and return inserted/modified/unchanged counts.
+
+    With base_version the write is refused (409) if the matrix changed after that version.
+    """
+    counts = {"inserted": 0, "modified": 0, "unchanged": 0}
+    async with price_matrix_update(base_version) as version:
+        operations = price_matrix_upserts(cells, version)
+        if operations:
+            # One round trip for the whole sheet; cells are independent, so order does not matter
+            result = await db.price_matrix.bulk_write(operations, ordered=False)
+            counts["inserted"] = result.upserted_count
+            counts["modified"] = result.modified_count
+            counts["unchanged"] = result.matched_count - result.modified_count
+    return counts
+
+def upload_result(counts: dict, rejected: List[dict]) -> dict:
+    updated = counts["inserted"] + counts["modified"]
+    return {
+        "message": f"{updated} Einträge aktualisiert, {counts['unchanged']} unverändert, {len(rejected)} abgelehnt",
+        "updated": updated,
+        **counts,
+        "rejected": len(rejected),
+        "rejected_rows": rejected[:MAX_REJECTED_ROWS_REPORTED]
+    }
+
+# Dry-run diffs waiting to be applied: diff_id -> {"version", "cells", "rejected", "created"}
+pending_price_matrix_diffs = {}
+PRICE_MATRIX_DIFF_TTL_SECONDS = 15 * 60
 
 @api_router.post("/price-matrix/upload")
 async def upload_price_matrix(
     file: UploadFile = File(...),
+    format: Optional[Literal["xlsx", "csv", "ndjson"]] = None,
+    dry_run: bool = False,
     current_user: dict = Depends(require_admin) # RBAC: Admin only
 ):
+    """Import a price matrix file.
+
+    With dry_run=true nothing is written: the response lists added, changed,
+    removed and invalid cells with old and new prices, plus a diff_id that
+    POST /price-matrix/diffs/{diff_id}/apply writes as one bulk write.
+    """
     # Security: Limit file size (approx check via read/chunk) or content-length if available
     # For now, we read safely.
     MAX_SIZE = 5 * 1024 * 1024 # 5MB limit
     
-    content = await file.read()
+    # Read at most one byte past the limit instead of buffering arbitrarily large uploads
+    content = await file.read(MAX_SIZE + 1)
     if len(content) > MAX_SIZE:
         raise HTTPException(status_code=413, detail="Datei zu gross (Max 5MB)")
         
     try:
-        df = pd.read_excel(io.BytesIO(content))
-        
-        required_cols = ["Kategorie", "Preisniveau", "Zustand", "Relevanz", "Fixpreis"]
-        if not all(col in df.columns for col in required_cols):
-            raise HTTPException(status_code=400, detail="Excel muss Spalten: Kategorie, Preisniveau, Zustand, Relevanz, Fixpreis enthalten")
+        # Parse in a worker thread so other tablets are not blocked while the file is read
+        fmt = requested_price_matrix_format(format, file.content_type, file.filename)
+        if fmt == "xlsx":
+            df = await asyncio.to_thread(read_price_matrix_workbook, content)
+        else:
+            df = await asyncio.to_thread(read_price_matrix_text, content, fmt)
+        cache = await get_price_matrix_cache()
+        valid, rejected = validate_price_matrix_frame(df, cache.categories)
         
-        updated = 0
-        for _, row in df.iterrows():
-            category = str(row["Kategorie"]).strip()
-            price_level = str(row["Preisniveau"]).strip()
-            condition = str(row["Zustand"]).strip()
-            relevance = str(row["Relevanz"]).strip()
-            
-            fixed_price = None
-            price_val = row["Fixpreis"]
-            if pd.notna(price_val) and str(price_val).strip() != "":
-                try:
-                    fixed_price = float(price_val)
-                except (ValueError, TypeError):
-                    pass
-            
-            if category not in CATEGORIES:
-                continue
-            if price_level not in PRICE_LEVELS:
-                continue
-            if condition not in CONDITIONS:
-                continue
-            if relevance not in RELEVANCE_LEVELS:
-                continue
-            
-            await db.price_matrix.update_one(
-                {
-                    "category": category,
-                    "price_level": price_level,
-                    "condition": condition,
-                    "relevance": relevance
-                },
-                {
-                    "$set": {
-                        "category": category,
-                        "price_level": price_level,
-                        "condition": condition,
-                        "relevance": relevance,
-                        "fixed_price": fixed_price
-                    }
-                },
-                upsert=True
-            )
-            updated += 1
+        if not dry_run:
+            return upload_result(await write_price_matrix_cells(valid), rejected)
         
-        return {"message": f"{updated} Einträge aktualisiert", "updated": updated}
+        diff = diff_price_matrix(cache, valid)
+        now = time.time()
+        for expired in [k for k, v in pending_price_matrix_diffs.items() if now - v["created"] > PRICE_MATRIX_DIFF_TTL_SECONDS]:
+            del pending_price_matrix_diffs[expired]
+        diff_id = str(uuid.uuid4())
+        pending_price_matrix_diffs[diff_id] = {
+            "version": cache.version,
+            "cells": diff[diff["change"] != "unchanged"].rename(columns={"new_price": "fixed_price"}),
+            "rejected": rejected,
+            "created": now
+        }
+        return {
+            "dry_run": True,
+            "diff_id": diff_id,
+            "version": cache.version,
+            "added": diff_records(diff, "added"),
+            "changed": diff_records(diff, "changed"),
+            "removed": diff_records(diff, "removed"),
+            "unchanged": int((diff["change"] == "unchanged").sum()),
+            "invalid": len(rejected),
+            "rejected_rows": rejected[:MAX_REJECTED_ROWS_REPORTED]
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Upload error: {e}")
         raise HTTPException(status_code=400, detail=str(e))
 
+@api_router.post("/price-matrix/diffs/{diff_id}/apply")
+async def apply_price_matrix_diff(diff_id: str, current_user: dict = Depends(require_admin)): # RBAC: Admin only
+    """Write exactly the cells of a dry-run diff, provided the matrix has not changed since."""
+    pending = pending_price_matrix_diffs.get(diff_id)
+    if not pending or time.time() - pending["created"] > PRICE_MATRIX_DIFF_TTL_SECONDS:
+        pending_price_matrix_diffs.pop(diff_id, None)
+        raise HTTPException(status_code=404, detail="Vorschau nicht gefunden oder abgelaufen")
+    counts = await write_price_matrix_cells(pending["cells"], base_version=pending["version"])
+    pending_price_matrix_diffs.pop(diff_id, None)
+    return upload_result(counts, pending["rejected"])
+
+@api_router.post("/price-suggestions/rebuild")
+async def rebuild_price_suggestion_index(current_user: dict = Depends(require_admin)): # RBAC: Admin only
+    cells = await rebuild_price_suggestions()
+    return {"message": f"Preisvorschläge für {cells} Kombinationen berechnet", "cells": cells}
+
 @api_router.delete("/price-matrix")
 async def clear_price_matrix(current_user: dict = Depends(require_admin)): # RBAC: Admin only
-    result = await db.price_matrix.delete_many({})
+    async with price_matrix_update() as version:
+        result = await db.price_matrix.delete_many({})
+        # Deleted cells leave no trace for delta sync, so clients older than this must resync fully
+        await db.app_settings.update_one({"type": "price_matrix"}, {"$set": {"cleared_version": version}})
     return {"message": f"{result.deleted_count} Einträge gelöscht"}
 
+# ============== Pricing Rules Routes ==============
+
+@api_router.get("/pricing-rules")
+async def get_pricing_rules(current_user: dict = Depends(get_current_user)):
+    rules = await db.pricing_rules.find_one({"id": "default"}, {"_id": 0, "id": 0})
+    return rules or PricingRules().model_dump()
+
+@api_router.put("/pricing-rules")
+async def update_pricing_rules(data: PricingRules, current_user: dict = Depends(require_admin)): # RBAC: Admin only
+    """Replace the pricing rules. Explicit price matrix cells keep taking precedence."""
+    categories = await get_all_categories()
+    for field, allowed in (
+        ("base_prices", categories),
+        ("price_levels", PRICE_LEVELS),
+        ("conditions", CONDITIONS),
+        ("relevance_levels", RELEVANCE_LEVELS),
+    ):
+        unknown = set(getattr(data, field)) - set(allowed)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unbekannte Werte in {field}: {', '.join(sorted(unknown))}")
+
+    async with price_matrix_update() as version:
+        await db.pricing_rules.replace_one(
+            {"id": "default"},
+            {"id": "default", **data.model_dump()},
+            upsert=True
+        )
+        # Delta sync clients older than this must resync fully
+        await db.app_settings.update_one({"type": "price_matrix"}, {"$set": {"rules_version": version}})
+    cache = await get_price_matrix_cache()
+    return {
+        "message": "Preisregeln gespeichert",
+        "version": cache.version,
+        "priced_cells": int((~np.isnan(cache.prices)).sum())
+    }
+
+# ============== Timestamps ==============
+# Timestamps are stored as BSON dates (UTC). Date filters are parsed into datetimes
+# so range queries compare like with like and can use the timestamp indexes. Filter
+# dates without an offset mean shop time, so history and exports cut days where the
+# statistics do.
+
+def parse_timestamp(value: str, default_tz=timezone.utc) -> datetime:
+    """Parse an ISO date or datetime; naive values are taken in default_tz (stored legacy values are UTC)."""
+    parsed = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=default_tz)
+
+def timestamp_range(start_date: Optional[str], end_date: Optional[str]) -> dict:
+    """Mongo range filter for the given dates in shop time; a bare end date includes that whole day."""
+    shop_tz = ZoneInfo(SHOP_TIMEZONE)
+    try:
+        query = {}
+        if start_date:
+            query["$gte"] = parse_timestamp(start_date, shop_tz).astimezone(timezone.utc)
+        if end_date:
+            end = parse_timestamp(end_date, shop_tz)
+            if len(end_date.strip()) == 10:
+                # Wall-clock arithmetic: the next shop midnight, also across DST changes
+                query["$lt"] = (end + timedelta(days=1)).astimezone(timezone.utc)
+            else:
+                query["$lte"] = end.astimezone(timezone.utc)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Ungültiges Datum")
+    return query
+
+def format_timestamp(value) -> str:
+    return value.isoformat() if isinstance(value, datetime) else str(value or "")
+
+# ============== Receipt Numbers ==============
+# Receipts and exports show a purchase as the first 8 characters of its id. That
+# number is stored as `short_id` (indexed) so it can be looked up directly.
+
+def short_id(doc_id: str) -> str:
+    return doc_id[:8].upper()
+
+UUID_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+def receipt_number_query(number: str) -> dict:
+    """Accept a full id (barcode) or a typed number such as "Nr. 1a2b3c4d"."""
+    number = number.strip()
+    if UUID_PATTERN.match(number.lower()):
+        return {"id": number.lower()}
+    number = re.sub(r"^(NR\.?|#)\s*", "", number.upper())
+    if not re.fullmatch(r"[0-9A-F]{8}", number):
+        raise HTTPException(status_code=400, detail="Ungültige Ankauf-Nummer")
+    return {"short_id": number}
+
+# ============== Idempotent Submission ==============
+# Clients send an Idempotency-Key header with POST /purchases and reuse it for
+# retries. The key is claimed for a purchase id before anything is written; a retry
+# finds the claim and answers with the stored purchase instead of creating another.
+# Keys expire via a TTL index.
+
+IDEMPOTENCY_KEY_TTL_SECONDS = 24 * 3600
+# A claim whose purchase never appeared (e.g. the server died mid-request) is taken over after this
+IDEMPOTENCY_CLAIM_TIMEOUT = timedelta(minutes=2)
+
+def purchase_response(purchase: dict) -> PurchaseResponse:
+    return PurchaseResponse(**{**purchase, "timestamp": format_timestamp(purchase.get("timestamp"))})
+
+async def claim_idempotency_key(key: str, purchase_id: str) -> Optional[dict]:
+    """Claim the key for purchase_id. Returns the purchase an earlier request created with it, if any."""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.idempotency_keys.insert_one({"key": key, "purchase_id": purchase_id, "created_at": now})
+        return None
+    except DuplicateKeyError:
+        pass
+    claim = await db.idempotency_keys.find_one({"key": key}, {"_id": 0})
+    if claim:
+        purchase = await db.purchases.find_one({"id": claim["purchase_id"]}, {"_id": 0})
+        if purchase:
+            return purchase
+    taken_over = await db.idempotency_keys.find_one_and_update(
+        {"key": key, "created_at": {"$lt": now - IDEMPOTENCY_CLAIM_TIMEOUT}},
+        {"$set": {"purchase_id": purchase_id, "created_at": now}}
+    )
+    if taken_over is None:
+        raise HTTPException(status_code=409, detail="Dieser Ankauf wird bereits verarbeitet")
+    return None
+
+# ============== Stats Rollups ==============
+# stats_rollups holds one document per shop day and per shop month
+# ({_id: "month:2024-05", period, key, count, total, item_count}). Purchases $inc
+# them in the same transaction that creates or soft-deletes them, so daily and
+# monthly statistics read a few small documents instead of scanning purchases.
+# rebuild_stats_rollups() recomputes them from scratch.
+#
+# A rebuild's $out replaces the collection with what its aggregation saw, which would
+# drop increments committed meanwhile; stats_rollups_lock keeps purchase writes and
+# rebuilds apart. Purchase writes only $inc, so they share the lock and still run
+# concurrently; only a rebuild takes it exclusively. Like the today tally this assumes
+# a single server process, so run the CLI rebuild while the server is stopped (or use
+# the admin endpoint).
+
+class SharedExclusiveLock:
+    """Any number of shared holders, or a single exclusive one.
+
+    A waiting exclusive holder keeps new shared holders out, so a rebuild is not
+    starved by a steady stream of checkouts.
+    """
+
+    def __init__(self):
+        self._condition = asyncio.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._exclusive_waiting = 0
+
+    @asynccontextmanager
+    async def shared(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._exclusive and not self._exclusive_waiting)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._shared -= 1
+                self._condition.notify_all()
+
+    @asynccontextmanager
+    async def exclusive(self):
+        async with self._condition:
+            self._exclusive_waiting += 1
+            try:
+                await self._condition.wait_for(lambda: not self._exclusive and not self._shared)
+            finally:
+                self._exclusive_waiting -= 1
+                # A cancelled wait must not keep shared holders blocked
+                self._condition.notify_all()
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
+
+stats_rollups_lock = SharedExclusiveLock()
+
+STATS_ROLLUP_FORMATS = {"day": "%Y-%m-%d", "month": "%Y-%m"}
+
+def stats_rollup_updates(purchase: dict, sign: int = 1) -> List[UpdateOne]:
+    timestamp = purchase["timestamp"]
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    local = timestamp.astimezone(ZoneInfo(SHOP_TIMEZONE))
+    increments = {
+        "count": sign,
+        "total": sign * purchase["total"],
+        "item_count": sign * len(purchase.get("items", []))
+    }
+    return [
+        UpdateOne(
+            {"_id": f"{period}:{local.strftime(fmt)}"},
+            {"$inc": increments, "$setOnInsert": {"period": period, "key": local.strftime(fmt)}},
+            upsert=True
+        )
+        for period, fmt in STATS_ROLLUP_FORMATS.items()
+    ]
+
+async def update_stats_rollups(purchase: dict, sign: int = 1, session=None):
+    await db.stats_rollups.bulk_write(stats_rollup_updates(purchase, sign), ordered=False, session=session)
+
+def stats_rollup_pipeline() -> List[dict]:
+    """All rollup documents, computed from the purchases that are not deleted."""
+    return [
+        {"$match": {"deleted": {"$ne": True}}},
+        {"$project": {
+            "total": 1,
+            "item_count": {"$size": {"$ifNull": ["$items", []]}},
+            "periods": [
+                {"period": period, "key": {"$dateToString": {"format": fmt, "date": "$timestamp", "timezone": SHOP_TIMEZONE}}}
+                for period, fmt in STATS_ROLLUP_FORMATS.items()
+            ]
+        }},
+        {"$unwind": "$periods"},
+        {"$group": {
+            "_id": {"$concat": ["$periods.period", ":", "$periods.key"]},
+            "period": {"$first": "$periods.period"},
+            "key": {"$first": "$periods.key"},
+            "count": {"$sum": 1},
+            "total": {"$sum": "$total"},
+            "item_count": {"$sum": "$item_count"}
+        }}
+    ]
+
+async def rebuild_stats_rollups() -> int:
+    """Recompute stats_rollups; $out swaps the collection in atomically and keeps its indexes."""
+    async with stats_rollups_lock.exclusive():
+        await db.purchases.aggregate(stats_rollup_pipeline() + [{"$out": "stats_rollups"}]).to_list(None)
+        return await db.stats_rollups.count_documents({})
+
+# ============== Today Tally ==============
+# The header counter on every tablet shows today's purchases. Rather than re-summing
+# them per poll, the process keeps a running tally for the current shop day: seeded
+# from Mongo once, then moved by create/delete and pushed to SSE subscribers.
+# Assumes a single server process (see Procfile); a second worker would keep its own tally.
+
+def shop_day(timestamp: datetime) -> str:
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(ZoneInfo(SHOP_TIMEZONE)).strftime("%Y-%m-%d")
+
+class TodayTally:
+    def __init__(self):
+        self.date = None
+        self.total_purchases = 0
+        self.total_amount = 0.0
+        self.total_items = 0
+        self.subscribers = set()
+        self.lock = asyncio.Lock()
+
+    def snapshot(self) -> dict:
+        return {
+            "date": self.date,
+            "total_purchases": self.total_purchases,
+            "total_amount": round(self.total_amount, 2),
+            "total_items": self.total_items
+        }
+
+    async def seed(self):
+        """Sum today's purchases in Mongo."""
+        async with self.lock:
+            start = shop_day_start(0)
+            totals = await db.purchases.aggregate([
+                {"$match": {"timestamp": {"$gte": start}, "deleted": {"$ne": True}}},
+                {"$group": {
+                    "_id": None,
+                    "count": {"$sum": 1},
+                    "total": {"$sum": "$total"},
+                    "items": {"$sum": {"$size": {"$ifNull": ["$items", []]}}}
+                }}
+            ]).to_list(1)
+            totals = totals[0] if totals else {}
+            self.date = start.strftime("%Y-%m-%d")
+            self.total_purchases = totals.get("count", 0)
+            self.total_amount = totals.get("total", 0.0)
+            self.total_items = totals.get("items", 0)
+        self.publish()
+
+    async def current(self) -> dict:
+        """Today's tally; seeds on first use and starts from zero at midnight."""
+        if self.date is None:
+            await self.seed()
+        elif self.date != shop_day(datetime.now(timezone.utc)):
+            self.reset()
+        return self.snapshot()
+
+    def reset(self):
+        self.date = shop_day(datetime.now(timezone.utc))
+        self.total_purchases = 0
+        self.total_amount = 0.0
+        self.total_items = 0
+        self.publish()
+
+    def apply(self, purchase: dict, sign: int = 1):
+        """Count a created (sign=1) or deleted (sign=-1) purchase if it belongs to today."""
+        if self.date is None:
+            return  # not seeded yet; the seed will include it
+        today = shop_day(datetime.now(timezone.utc))
+        if self.date != today:
+            self.reset()
+        if shop_day(purchase["timestamp"]) != today:
+            return
+        self.total_purchases += sign
+        self.total_amount += sign * purchase["total"]
+        self.total_items += sign * len(purchase.get("items", []))
+        self.publish()
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=1)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def publish(self):
+        snapshot = self.snapshot()
+        for queue in self.subscribers:
+            # Subscribers only need the latest totals; replace anything unread
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(snapshot)
+
+today_tally = TodayTally()
+
+# Comment lines keep idle connections open through proxies
+TODAY_STREAM_KEEPALIVE_SECONDS = 15
+
 # ============== Purchase Routes ==============
 
+# Draws of a fresh id when its receipt number is already taken; a second clash is already improbable
+RECEIPT_NUMBER_ATTEMPTS = 5
+
+async def insert_purchase(purchase_dict: dict, transaction_doc: Optional[dict], customer_id: Optional[str], total_sum: float):
+    """Write the purchase, its stats rollups and (with credit) balance and ledger entry in one transaction.
+
+    $inc is atomic, so two tablets crediting the same customer cannot lose an update.
+    """
+    async with stats_rollups_lock.shared():
+        async with await client.start_session() as session:
+            async with session.start_transaction():
+                if transaction_doc:
+                    customer = await db.customers.find_one_and_update(
+                        {"id": customer_id},
+                        {"$inc": {"current_balance": total_sum}},
+                        projection={"_id": 0, "first_name": 1, "last_name": 1},
+                        session=session
+                    )
+                    if not customer:
+                        # Leaving the block with an exception aborts the transaction
+                        raise HTTPException(status_code=404, detail="Kunde nicht gefunden")
+                    
+                    purchase_dict["credit_customer_name"] = f"{customer.get('first_name', '')} {customer.get('last_name', '')}"
+                    await db.credit_transactions.insert_one(transaction_doc, session=session)
+                await db.purchases.insert_one(purchase_dict, session=session)
+                await update_stats_rollups(purchase_dict, session=session)
+
 @api_router.post("/purchases", response_model=PurchaseResponse)
-async def create_purchase(purchase_data: PurchaseCreate, current_user: dict = Depends(get_current_user)):
+async def create_purchase(
+    purchase_data: PurchaseCreate,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=200),
+    current_user: dict = Depends(get_current_user)
+):
     total_sum = sum(item.price for item in purchase_data.items)
     
     new_items = [
@@ -530,46 +1498,62 @@ async def create_purchase(purchase_data: PurchaseCreate, current_user: dict = De
         # Audit Trail: Force username from token, ignore client input
         staff_username=current_user["username"]
     )
+    if idempotency_key:
+        earlier = await claim_idempotency_key(idempotency_key, new_purchase.id)
+        if earlier:
+            return purchase_response(earlier)
     
-    # Check if this should be credited to a customer
-    credit_customer_name = None
-    if purchase_data.credit_customer_id:
-        customer = await db.customers.find_one({"id": purchase_data.credit_customer_id})
-        if not customer:
-            raise HTTPException(status_code=404, detail="Kunde nicht gefunden")
-        
-        credit_customer_name = f"{customer.get('first_name', '')} {customer.get('last_name', '')}"
-        
-        # Create credit transaction
-        transaction = CreditTransaction(
-            customer_id=purchase_data.credit_customer_id,
-            amount=total_sum,  # Positive = credit
-            type="purchase_credit",
-            description=f"Ankauf #{new_purchase.id[:8].upper()} - {len(new_items)} Artikel",
-            reference_id=new_purchase.id,
-            staff_username=current_user["username"] # Audit Trail: Force username from token
-        )
-        
-        transaction_doc = transaction.model_dump()
-        transaction_doc["timestamp"] = transaction.timestamp
-        await db.credit_transactions.insert_one(transaction_doc)
-        
-        # Update customer balance
-        new_balance = customer.get("current_balance", 0) + total_sum
-        await db.customers.update_one(
-            {"id": purchase_data.credit_customer_id},
-            {"$set": {"current_balance": new_balance}}
-        )
+    try:
+        for attempt in range(RECEIPT_NUMBER_ATTEMPTS):
+            purchase_dict = new_purchase.model_dump()
+            purchase_dict["short_id"] = short_id(new_purchase.id)
+            purchase_dict["short_id_unique"] = True
+            # Explicitly overwrite staff_username to ensure integrity
+            purchase_dict["staff_username"] = current_user["username"]
+            purchase_dict["credit_customer_id"] = purchase_data.credit_customer_id
+            purchase_dict["credit_customer_name"] = None
+            
+            # Check if this should be credited to a customer
+            transaction_doc = None
+            if purchase_data.credit_customer_id:
+                transaction = CreditTransaction(
+                    customer_id=purchase_data.credit_customer_id,
+                    amount=total_sum,  # Positive = credit
+                    type="purchase_credit",
+                    description=f"Ankauf #{purchase_dict['short_id']} - {len(new_items)} Artikel",
+                    reference_id=new_purchase.id,
+                    staff_username=current_user["username"] # Audit Trail: Force username from token
+                )
+                transaction_doc = transaction.model_dump()
+                transaction_doc["timestamp"] = transaction.timestamp
+                transaction_doc["short_id"] = purchase_dict["short_id"]
+            
+            try:
+                await insert_purchase(purchase_dict, transaction_doc, purchase_data.credit_customer_id, total_sum)
+                break
+            except DuplicateKeyError as e:
+                # Keep receipt numbers unambiguous: on the rare 8-character clash the unique
+                # index aborts the transaction, so draw a new id and write everything again
+                if "short_id" not in (e.details or {}).get("keyPattern", {}) or attempt + 1 == RECEIPT_NUMBER_ATTEMPTS:
+                    raise
+                clashing_id, new_purchase.id = new_purchase.id, str(uuid.uuid4())
+                if idempotency_key:
+                    await db.idempotency_keys.update_one(
+                        {"key": idempotency_key, "purchase_id": clashing_id},
+                        {"$set": {"purchase_id": new_purchase.id}}
+                    )
         
-        logger.info(f"Credited {total_sum} CHF to customer {credit_customer_name} for purchase {new_purchase.id}")
-    
-    purchase_dict = new_purchase.model_dump()
-    # Explicitly overwrite staff_username to ensure integrity
-    purchase_dict["staff_username"] = current_user["username"]
-    purchase_dict["credit_customer_id"] = purchase_data.credit_customer_id
-    purchase_dict["credit_customer_name"] = credit_customer_name
+        credit_customer_name = purchase_dict["credit_customer_name"]
+        if transaction_doc:
+            logger.info(f"Credited {total_sum} CHF to customer {credit_customer_name} for purchase {new_purchase.id}")
+    except Exception:
+        # Release the key so a retry can create the purchase after all
+        if idempotency_key:
+            await db.idempotency_keys.delete_one({"key": idempotency_key, "purchase_id": new_purchase.id})
+        raise
     
-    await db.purchases.insert_one(purchase_dict)
+    schedule_price_suggestion_refresh(purchase_dict["items"])
+    today_tally.apply(purchase_dict)
     
     return PurchaseResponse(
         id=new_purchase.id,
@@ -581,27 +1565,63 @@ async def create_purchase(purchase_data: PurchaseCreate, current_user: dict = De
         credit_customer_name=credit_customer_name
     )
 
-@api_router.get("/purchases", response_model=List[PurchaseResponse])
+PURCHASE_SUMMARY_PROJECTION = {
+    "_id": 0, "id": 1, "total": 1, "timestamp": 1, "staff_username": 1,
+    "credit_customer_id": 1, "credit_customer_name": 1, "item_count": {"$size": "$items"}
+}
+
+@api_router.get("/purchases", response_model=PurchasePage)
 async def get_purchases(
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    include_items: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
+    """One page of purchases, newest first. Items are only sent when asked for.
+
+    The first page (no cursor) also carries `total_count`, the number of matching
+    purchases: from the monthly rollups without a date filter, counted otherwise.
+    """
     query = {"deleted": {"$ne": True}}
     
     if start_date or end_date:
-        query["timestamp"] = {}
-        if start_date:
-            query["timestamp"]["$gte"] = start_date
-        if end_date:
-            query["timestamp"]["$lte"] = end_date
+        query["timestamp"] = timestamp_range(start_date, end_date)
     
-    purchases = await db.purchases.find(query, {"_id": 0}).sort("timestamp", -1).to_list(1000)
-    # Ensure timestamps are strings for PurchaseResponse
+    projection = {**PURCHASE_SUMMARY_PROJECTION, "items": 1} if include_items else PURCHASE_SUMMARY_PROJECTION
+    purchases, next_cursor = await keyset_page(
+        db.purchases, query, projection, "timestamp", limit, cursor, descending=True
+    )
+    # Ensure timestamps are strings for the response
     for p in purchases:
-        if p.get("timestamp") and not isinstance(p["timestamp"], str):
-            p["timestamp"] = p["timestamp"].isoformat()
-    return purchases
+        p["timestamp"] = format_timestamp(p.get("timestamp"))
+    
+    total_count = None
+    if not cursor:
+        if "timestamp" in query:
+            total_count = await db.purchases.count_documents(query)
+        else:
+            totals = await db.stats_rollups.aggregate([
+                {"$match": {"period": "month"}},
+                {"$group": {"_id": None, "count": {"$sum": "$count"}}}
+            ]).to_list(1)
+            total_count = totals[0]["count"] if totals else 0
+    return {"purchases": purchases, "next_cursor": next_cursor, "total_count": total_count}
+
+@api_router.get("/purchases/by-number/{number}", response_model=PurchaseResponse)
+async def get_purchase_by_number(number: str, current_user: dict = Depends(get_current_user)):
+    """Find a purchase by its receipt number (or full id from a receipt barcode)."""
+    query = {**receipt_number_query(number), "deleted": {"$ne": True}}
+    matches = await db.purchases.find(query, {"_id": 0}).limit(2).to_list(2)
+    if not matches:
+        raise HTTPException(status_code=404, detail="Purchase not found")
+    if len(matches) > 1:
+        # Only possible for purchases created before numbers were kept unique
+        raise HTTPException(status_code=409, detail="Mehrere Ankäufe mit dieser Nummer - bitte vollständige ID verwenden")
+    purchase = matches[0]
+    purchase["timestamp"] = format_timestamp(purchase.get("timestamp"))
+    return purchase
 
 @api_router.get("/purchases/{purchase_id}", response_model=PurchaseResponse)
 async def get_purchase(purchase_id: str, current_user: dict = Depends(get_current_user)):
@@ -616,12 +1636,20 @@ async def get_purchase(purchase_id: str, current_user: dict = Depends(get_curren
 @api_router.delete("/purchases/{purchase_id}")
 async def delete_purchase(purchase_id: str, current_user: dict = Depends(require_admin)): # RBAC: Admin only
     # GeBüV compliance: soft-delete to preserve audit trail
-    result = await db.purchases.update_one(
-        {"id": purchase_id, "deleted": {"$ne": True}},
-        {"$set": {"deleted": True, "deleted_at": datetime.now(timezone.utc).isoformat(), "deleted_by": current_user["username"]}}
-    )
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Purchase not found")
+    async with stats_rollups_lock.shared():
+        async with await client.start_session() as session:
+            async with session.start_transaction():
+                purchase = await db.purchases.find_one_and_update(
+                    {"id": purchase_id, "deleted": {"$ne": True}},
+                    {"$set": {"deleted": True, "deleted_at": datetime.now(timezone.utc).isoformat(), "deleted_by": current_user["username"]}},
+                    projection={"_id": 0, "items": 1, "total": 1, "timestamp": 1},
+                    session=session
+                )
+                if purchase is None:
+                    raise HTTPException(status_code=404, detail="Purchase not found")
+                await update_stats_rollups(purchase, sign=-1, session=session)
+    today_tally.apply(purchase, sign=-1)
+    schedule_price_suggestion_refresh(purchase.get("items", []))
     return {"message": "Purchase deleted"}
 
 @api_router.delete("/purchases")
@@ -631,6 +1659,9 @@ async def delete_all_purchases(current_user: dict = Depends(require_admin)): # R
         {"deleted": {"$ne": True}},
         {"$set": {"deleted": True, "deleted_at": datetime.now(timezone.utc).isoformat(), "deleted_by": current_user["username"]}}
     )
+    run_in_background(rebuild_price_suggestions(), "Price suggestion rebuild")
+    await rebuild_stats_rollups()
+    today_tally.reset()
     return {"message": f"{result.modified_count} Ankäufe gelöscht"}
 
 # Export all purchases as Excel
@@ -639,27 +1670,23 @@ async def export_purchases_excel(start_date: Optional[str] = None, end_date: Opt
     query = {"deleted": {"$ne": True}}
     
     if start_date or end_date:
-        query["timestamp"] = {}
-        if start_date:
-            query["timestamp"]["$gte"] = start_date
-        if end_date:
-            # Add time to include the entire end day
-            query["timestamp"]["$lte"] = end_date + "T23:59:59"
+        query["timestamp"] = timestamp_range(start_date, end_date)
     
     # Optimized: Only fetch required fields, limit to 50000 for performance
     purchases = await db.purchases.find(
         query, 
-        {"_id": 0, "id": 1, "timestamp": 1, "total": 1, "items": 1}
+        {"_id": 0, "id": 1, "short_id": 1, "timestamp": 1, "total": 1, "items": 1}
     ).sort("timestamp", -1).to_list(50000)
     
     # Flatten purchases into rows (one row per item)
     rows = []
     for p in purchases:
+        ts = format_timestamp(p["timestamp"])
         for item in p["items"]:
             rows.append({
-                "Datum": p["timestamp"][:10],
-                "Zeit": p["timestamp"][11:16] if len(p["timestamp"]) > 16 else "",
-                "Ankauf-Nr": p["id"][:8].upper(),
+                "Datum": ts[:10],
+                "Zeit": ts[11:16] if len(ts) > 16 else "",
+                "Ankauf-Nr": p.get("short_id") or short_id(p["id"]),
                 "Kategorie": item.get("category", ""),
                 "Preisniveau": item.get("price_level", ""),
                 "Zustand": item.get("condition", ""),
@@ -712,75 +1739,63 @@ async def export_purchases_excel(start_date: Optional[str] = None, end_date: Opt
 
 # ============== Stats Routes ==============
 
+def shop_day_start(days_ago: int = 0) -> datetime:
+    """Midnight in the shop's time zone, `days_ago` days before today."""
+    local_today = datetime.now(ZoneInfo(SHOP_TIMEZONE)).date() - timedelta(days=days_ago)
+    return datetime.combine(local_today, datetime.min.time(), tzinfo=ZoneInfo(SHOP_TIMEZONE))
+
 @api_router.get("/stats/daily", response_model=List[DailyStats])
-async def get_daily_stats(days: int = 30, current_user: dict = Depends(get_current_user)):
-    start_date = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
-    
-    purchases = await db.purchases.find(
-        {"timestamp": {"$gte": start_date}, "deleted": {"$ne": True}},
-        {"_id": 0}
-    ).to_list(10000)
-    
-    daily_data = {}
-    for p in purchases:
-        ts = p["timestamp"]
-        date_str = ts.strftime("%Y-%m-%d") if hasattr(ts, 'strftime') else str(ts)[:10]
-        if date_str not in daily_data:
-            daily_data[date_str] = {"count": 0, "total": 0.0}
-        daily_data[date_str]["count"] += 1
-        daily_data[date_str]["total"] += p["total"]
-    
-    result = [
-        DailyStats(date=date, count=data["count"], total=data["total"])
-        for date, data in sorted(daily_data.items(), reverse=True)
-    ]
-    
-    return result
+async def get_daily_stats(days: int = Query(30, ge=1, le=366), current_user: dict = Depends(get_current_user)):
+    """Count and total per shop calendar day for the last `days` days (today included), newest first."""
+    rollups = await db.stats_rollups.find(
+        {"period": "day", "key": {"$gte": shop_day_start(days - 1).strftime("%Y-%m-%d")}, "count": {"$gt": 0}},
+        {"_id": 0, "key": 1, "count": 1, "total": 1}
+    ).sort("key", -1).to_list(days)
+    return [DailyStats(date=r["key"], count=r["count"], total=r["total"]) for r in rollups]
 
 @api_router.get("/stats/monthly", response_model=List[MonthlyStats])
-async def get_monthly_stats(months: int = 12, current_user: dict = Depends(get_current_user)):
-    # Optimized: Only fetch required fields and limit results
-    purchases = await db.purchases.find(
-        {"deleted": {"$ne": True}}, 
-        {"_id": 0, "timestamp": 1, "total": 1}
-    ).to_list(50000)
-    
-    monthly_data = {}
-    for p in purchases:
-        ts = p["timestamp"]
-        month_str = ts.strftime("%Y-%m") if hasattr(ts, 'strftime') else str(ts)[:7]
-        if month_str not in monthly_data:
-            monthly_data[month_str] = {"count": 0, "total": 0.0}
-        monthly_data[month_str]["count"] += 1
-        monthly_data[month_str]["total"] += p["total"]
-    
-    result = [
-        MonthlyStats(month=month, count=data["count"], total=data["total"])
-        for month, data in sorted(monthly_data.items(), reverse=True)
-    ][:months]
-    
-    return result
+async def get_monthly_stats(months: int = Query(12, ge=1, le=120), current_user: dict = Depends(get_current_user)):
+    """Count and total per shop month, newest first, read from the monthly rollups."""
+    rollups = await db.stats_rollups.find(
+        {"period": "month", "count": {"$gt": 0}},
+        {"_id": 0, "key": 1, "count": 1, "total": 1}
+    ).sort("key", -1).limit(months).to_list(months)
+    return [MonthlyStats(month=r["key"], count=r["count"], total=r["total"]) for r in rollups]
+
+@api_router.post("/stats/rollups/rebuild")
+async def rebuild_stats_rollup_collection(current_user: dict = Depends(require_admin)): # RBAC: Admin only
+    documents = await rebuild_stats_rollups()
+    return {"message": f"{documents} Statistik-Einträge neu berechnet", "documents": documents}
 
 @api_router.get("/stats/today")
 async def get_today_stats(current_user: dict = Depends(get_current_user)):
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    
-    # Optimized: Use date range query instead of regex, only fetch needed fields
-    purchases = await db.purchases.find(
-        {"timestamp": {"$gte": today, "$lt": today + "T23:59:59"}, "deleted": {"$ne": True}},
-        {"_id": 0, "total": 1, "items": 1}
-    ).to_list(1000)
-    
-    total_purchases = len(purchases)
-    total_amount = sum(p["total"] for p in purchases)
-    total_items = sum(len(p["items"]) for p in purchases)
+    """Today's purchase count, amount and items, served from the in-memory tally."""
+    return await today_tally.current()
+
+@api_router.get("/stats/today/stream")
+async def stream_today_stats(request: Request, current_user: dict = Depends(get_current_user)):
+    """Server-Sent Events: the current tally, then every change to it."""
+    async def events():
+        queue = today_tally.subscribe()
+        try:
+            yield f"data: {json.dumps(await today_tally.current())}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    snapshot = await asyncio.wait_for(queue.get(), timeout=TODAY_STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # Also rolls the tally over at midnight when nothing is sold
+                    await today_tally.current()
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {json.dumps(snapshot)}\n\n"
+        finally:
+            today_tally.unsubscribe(queue)
     
-    return {
-        "date": today,
-        "total_purchases": total_purchases,
-        "total_amount": total_amount,
-        "total_items": total_items
-    }
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 class LoginRequest(BaseModel):
@@ -834,7 +1849,8 @@ async def add_custom_category(data: CustomCategoryCreate, current_user: dict = D
     if existing:
         raise HTTPException(status_code=400, detail="Kategorie existiert bereits")
     
-    await db.custom_categories.insert_one({"name": name, "image": data.image, "icon": data.icon})
+    async with price_matrix_update():
+        await db.custom_categories.insert_one({"name": name, "image": data.image, "icon": data.icon})
     return {"message": f"Kategorie '{name}' hinzugefügt"}
 
 @api_router.put("/custom-categories/{name}/image")
@@ -849,7 +1865,8 @@ async def update_category_image(name: str, data: CategoryImageUpdate, current_us
 
 @api_router.delete("/custom-categories/{name}")
 async def delete_custom_category(name: str, current_user: dict = Depends(require_admin)): # RBAC: Admin only
-    result = await db.custom_categories.delete_one({"name": name})
+    async with price_matrix_update():
+        result = await db.custom_categories.delete_one({"name": name})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Kategorie nicht gefunden")
     return {"message": f"Kategorie '{name}' gelöscht"}
@@ -932,31 +1949,187 @@ async def update_receipt_settings(data: ReceiptSettingsUpdate, current_user: dic
     )
     return {"message": "Quittungs-Einstellungen gespeichert"}
 
+# ============== Keyset Pagination ==============
+# Pages continue after the (sort value, id) of the last row returned instead of
+# skipping rows, so deep pages cost the same as the first and concurrent inserts
+# never shift or duplicate rows. Cursors are opaque to clients.
+
+def encode_cursor(value, doc_id: str) -> str:
+    if isinstance(value, datetime):
+        value = {"$date": value.isoformat()}
+    raw = json.dumps([value, doc_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        value, doc_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if isinstance(value, dict):
+            value = datetime.fromisoformat(value["$date"])
+        if not isinstance(doc_id, str):
+            raise ValueError(doc_id)
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Ungültiger Cursor")
+    return value, doc_id
+
+def keyset_filter(field: str, cursor: str, descending: bool = False) -> dict:
+    """Rows strictly after the cursor in (field, id) order."""
+    value, doc_id = decode_cursor(cursor)
+    op = "$lt" if descending else "$gt"
+    return {"$or": [{field: {op: value}}, {field: value, "id": {op: doc_id}}]}
+
+async def keyset_page(collection, query: dict, projection: dict, field: str,
+                      limit: int, cursor: Optional[str] = None, descending: bool = False) -> tuple:
+    """One page sorted by (field, id) plus the cursor for the next page, if any."""
+    if cursor:
+        query = {"$and": [query, keyset_filter(field, cursor, descending)]} if query else keyset_filter(field, cursor, descending)
+    direction = -1 if descending else 1
+    docs = await collection.find(query, projection).sort(
+        [(field, direction), ("id", direction)]
+    ).limit(limit + 1).to_list(limit + 1)
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(docs[-1].get(field), docs[-1]["id"])
+    return docs, next_cursor
+
+# ============== Customer Search Keys ==============
+# Customers carry `search_keys`: normalized name/email tokens behind a multikey index,
+# searched with anchored (prefix) regexes, which - unlike unanchored, case-insensitive
+# ones - can use index bounds.
+
+GERMAN_TRANSLITERATION = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+
+def fold_accents(text: str) -> str:
+    return "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+
+def normalize_search_text(text: str) -> str:
+    """Lower-case, transliterate umlauts (Müller -> mueller) and strip remaining accents."""
+    return fold_accents(text.lower().translate(GERMAN_TRANSLITERATION))
+
+def customer_search_keys(first_name: str, last_name: str, email: Optional[str]) -> List[str]:
+    """Every token in both spellings, so "mueller" and "muller" both find "Müller"."""
+    keys = set()
+    for value in (first_name, last_name, f"{first_name} {last_name}"):
+        value = value or ""
+        for variant in (normalize_search_text(value), fold_accents(value.lower())):
+            keys.add(variant.strip())
+            keys.update(variant.split())
+    if email:
+        email = email.lower().strip()
+        keys.update({email, email.split("@")[0]})
+    keys.discard("")
+    return sorted(keys)
+
+def customer_search_query(search: str) -> dict:
+    """Every search term must be the prefix of some key."""
+    terms = normalize_search_text(search).split()
+    if not terms:
+        return {}
+    return {"search_keys": {"$all": [re.compile("^" + re.escape(term)) for term in terms]}}
+
+async def backfill_customer_search_keys() -> int:
+    """Add search_keys to customers created before they existed."""
+    customers = await db.customers.find(
+        {"search_keys": {"$exists": False}},
+        {"_id": 0, "id": 1, "first_name": 1, "last_name": 1, "email": 1}
+    ).to_list(None)
+    if customers:
+        await db.customers.bulk_write([
+            UpdateOne({"id": c["id"]}, {"$set": {"search_keys": customer_search_keys(
+                c.get("first_name", ""), c.get("last_name", ""), c.get("email")
+            )}})
+            for c in customers
+        ], ordered=False)
+    return len(customers)
+
+# ============== Customer Balance Checkpoints ==============
+# A checkpoint stores a customer's balance including every transaction up to `as_of`,
+# so the balance is checkpoint + sum of newer transactions instead of a full rescan.
+
+BALANCE_CHECKPOINT_INTERVAL = 500  # Settled transactions after the last checkpoint that trigger a new one
+BALANCE_SETTLE_DELAY = timedelta(hours=1)  # Only checkpoint transactions old enough that no insert is still in flight
+
+async def compute_customer_balance(customer_id: str) -> dict:
+    """Balance and transaction count from the latest checkpoint plus newer transactions.
+
+    The sum runs server-side; a new checkpoint is written once enough settled
+    transactions have accumulated after the previous one.
+    """
+    checkpoint = await db.balance_checkpoints.find_one(
+        {"customer_id": customer_id}, {"_id": 0}, sort=[("as_of", -1)]
+    )
+    base_balance = checkpoint["balance"] if checkpoint else 0.0
+    base_count = checkpoint["transaction_count"] if checkpoint else 0
+
+    match = {"customer_id": customer_id}
+    if checkpoint:
+        # Legacy non-date timestamps cannot be ordered against as_of and are never checkpointed
+        match["$or"] = [{"timestamp": {"$gt": checkpoint["as_of"]}}, {"timestamp": {"$not": {"$type": "date"}}}]
+    settle_before = datetime.now(timezone.utc) - BALANCE_SETTLE_DELAY
+    settled = {"$and": [{"$eq": [{"$type": "$timestamp"}, "date"]}, {"$lte": ["$timestamp", settle_before]}]}
+    rows = await db.credit_transactions.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": None,
+            "total": {"$sum": "$amount"},
+            "count": {"$sum": 1},
+            "settled_total": {"$sum": {"$cond": [settled, "$amount", 0]}},
+            "settled_count": {"$sum": {"$cond": [settled, 1, 0]}}
+        }}
+    ]).to_list(1)
+    agg = rows[0] if rows else {"total": 0.0, "count": 0, "settled_total": 0.0, "settled_count": 0}
+
+    if agg["settled_count"] >= BALANCE_CHECKPOINT_INTERVAL:
+        await db.balance_checkpoints.insert_one({
+            "customer_id": customer_id,
+            "balance": base_balance + agg["settled_total"],
+            "transaction_count": base_count + agg["settled_count"],
+            "as_of": settle_before,
+            "created_at": datetime.now(timezone.utc)
+        })
+
+    return {"balance": base_balance + agg["total"], "transaction_count": base_count + agg["count"]}
+
 # ============== Customer Routes ==============
 
-@api_router.get("/customers", response_model=List[CustomerResponse])
-async def get_customers(search: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    """Get all customers, optionally filtered by search term (name or email)."""
-    query = {}
-    if search:
-        escaped_search = re.escape(search)
-        search_regex = {"$regex": escaped_search, "$options": "i"}
-        query = {"$or": [
-            {"first_name": search_regex},
-            {"last_name": search_regex},
-            {"email": search_regex}
-        ]}
-    
-    customers = await db.customers.find(query, {"_id": 0}).sort("last_name", 1).to_list(500)
-    
-    # Convert datetime to string for response
-    for c in customers:
-        if isinstance(c.get("created_at"), datetime):
-            c["created_at"] = c["created_at"].isoformat()
-        elif "created_at" not in c:
-            c["created_at"] = datetime.now(timezone.utc).isoformat()
-    
-    return customers
+CUSTOMER_LIST_PROJECTION = {"_id": 0, "id": 1, "first_name": 1, "last_name": 1, "email": 1, "current_balance": 1}
+TRANSACTION_PROJECTION = {"_id": 0, "customer_id": 0}
+
+@api_router.get("/customers", response_model=CustomerPage)
+async def get_customers(
+    search: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """One page of customers by last name, optionally filtered by search term (name or email prefix)."""
+    query = customer_search_query(search) if search else {}
+    customers, next_cursor = await keyset_page(
+        db.customers, query, CUSTOMER_LIST_PROJECTION, "last_name", limit, cursor
+    )
+    return {"customers": customers, "next_cursor": next_cursor}
+
+@api_router.get("/customers/typeahead")
+async def customer_typeahead(
+    q: str,
+    limit: int = Query(10, ge=1, le=25),
+    current_user: dict = Depends(get_current_user)
+):
+    """Top matches for a search box: only id, name and balance."""
+    if not normalize_search_text(q).strip():
+        return []
+    customers = await db.customers.find(
+        customer_search_query(q),
+        {"_id": 0, "id": 1, "first_name": 1, "last_name": 1, "current_balance": 1}
+    ).sort("last_name", 1).limit(limit).to_list(limit)
+    return [
+        {
+            "id": c["id"],
+            "name": f"{c.get('first_name', '')} {c.get('last_name', '')}",
+            "current_balance": c.get("current_balance", 0)
+        }
+        for c in customers
+    ]
 
 @api_router.post("/customers", response_model=CustomerResponse)
 async def create_customer(data: CustomerCreate, current_user: dict = Depends(get_current_user)):
@@ -976,6 +2149,7 @@ async def create_customer(data: CustomerCreate, current_user: dict = Depends(get
     
     doc = customer.model_dump()
     doc["created_at"] = customer.created_at
+    doc["search_keys"] = customer_search_keys(customer.first_name, customer.last_name, customer.email)
     await db.customers.insert_one(doc)
     
     return CustomerResponse(
@@ -990,41 +2164,58 @@ async def create_customer(data: CustomerCreate, current_user: dict = Depends(get
     )
 
 @api_router.get("/customers/{customer_id}")
-async def get_customer(customer_id: str, current_user: dict = Depends(get_current_user)):
-    """Get a single customer with their transaction history."""
-    customer = await db.customers.find_one({"id": customer_id}, {"_id": 0})
+async def get_customer(
+    customer_id: str,
+    limit: int = Query(50, ge=1, le=200),
+    current_user: dict = Depends(get_current_user)
+):
+    """Get a single customer with the first page of their transaction history (newest first)."""
+    customer = await db.customers.find_one({"id": customer_id}, {"_id": 0, "search_keys": 0})
     if not customer:
         raise HTTPException(status_code=404, detail="Kunde nicht gefunden")
     
-    # Get all transactions for this customer
-    transactions = await db.credit_transactions.find(
-        {"customer_id": customer_id}, {"_id": 0}
-    ).sort("timestamp", -1).to_list(1000)
-    
     # Calculate actual balance from transactions (source of truth)
-    actual_balance = sum(t["amount"] for t in transactions)
+    ledger = await compute_customer_balance(customer_id)
+    actual_balance = ledger["balance"]
     
-    # Update cached balance if different
-    if customer.get("current_balance", 0) != actual_balance:
+    # Update cached balance if different (tolerate float summation noise). Only
+    # if it still holds the value read above, so a concurrent $inc is never lost.
+    if abs(customer.get("current_balance", 0) - actual_balance) > 0.005:
         await db.customers.update_one(
-            {"id": customer_id},
+            {"id": customer_id, "current_balance": customer.get("current_balance")},
             {"$set": {"current_balance": actual_balance}}
         )
     
+    page = await get_customer_transactions(customer_id, limit=limit, current_user=current_user)
+    
     # Format timestamps
     if isinstance(customer.get("created_at"), datetime):
         customer["created_at"] = customer["created_at"].isoformat()
     
-    for t in transactions:
-        if isinstance(t.get("timestamp"), datetime):
-            t["timestamp"] = t["timestamp"].isoformat()
-    
     return {
         **customer,
         "current_balance": actual_balance,
-        "transactions": transactions
+        **page,
+        "transaction_count": ledger["transaction_count"]
     }
 
+@api_router.get("/customers/{customer_id}/transactions")
+async def get_customer_transactions(
+    customer_id: str,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """One page of a customer's transaction history (newest first)."""
+    transactions, next_cursor = await keyset_page(
+        db.credit_transactions, {"customer_id": customer_id}, TRANSACTION_PROJECTION,
+        "timestamp", limit, cursor, descending=True
+    )
+    for t in transactions:
+        if isinstance(t.get("timestamp"), datetime):
+            t["timestamp"] = t["timestamp"].isoformat()
+    return {"transactions": transactions, "next_cursor": next_cursor, "has_more": next_cursor is not None}
+
 @api_router.put("/customers/{customer_id}")
 async def update_customer(customer_id: str, data: CustomerCreate, current_user: dict = Depends(get_current_user)):
     """Update customer details."""
@@ -1045,7 +2236,8 @@ async def update_customer(customer_id: str, data: CustomerCreate, current_user:
             "last_name": data.last_name.strip(),
             "email": data.email.lower().strip(),
             "address": data.address.strip() if data.address else None,
-            "phone": data.phone.strip() if data.phone else None
+            "phone": data.phone.strip() if data.phone else None,
+            "search_keys": customer_search_keys(data.first_name.strip(), data.last_name.strip(), data.email.lower().strip())
         }}
     )
     
@@ -1060,20 +2252,20 @@ async def delete_customer(customer_id: str, current_user: dict = Depends(require
     
     # Also delete their transactions
     await db.credit_transactions.delete_many({"customer_id": customer_id})
+    await db.balance_checkpoints.delete_many({"customer_id": customer_id})
     
     return {"message": "Kunde gelöscht"}
 
 @api_router.post("/customers/{customer_id}/transactions")
 async def create_transaction(customer_id: str, data: TransactionCreate, current_user: dict = Depends(get_current_user)):
     """Create a manual transaction (credit or debit)."""
-    customer = await db.customers.find_one({"id": customer_id})
-    if not customer:
-        raise HTTPException(status_code=404, detail="Kunde nicht gefunden")
-    
     # Determine amount sign based on type
     amount = abs(data.amount)
+    balance_filter = {"id": customer_id}
     if data.type == "debit":
         amount = -amount
+        # Overdraw guard: the debit only matches while the balance covers it
+        balance_filter["current_balance"] = {"$gte": -amount}
     
     transaction = CreditTransaction(
         customer_id=customer_id,
@@ -1086,19 +2278,79 @@ async def create_transaction(customer_id: str, data: TransactionCreate, current_
     
     doc = transaction.model_dump()
     doc["timestamp"] = transaction.timestamp
-    await db.credit_transactions.insert_one(doc)
     
-    # Update cached balance
-    new_balance = customer.get("current_balance", 0) + amount
-    await db.customers.update_one(
-        {"id": customer_id},
-        {"$set": {"current_balance": new_balance}}
-    )
+    # Check-and-update in one atomic step; the ledger entry commits with it
+    async with await client.start_session() as session:
+        async with session.start_transaction():
+            customer = await db.customers.find_one_and_update(
+                balance_filter,
+                {"$inc": {"current_balance": amount}},
+                projection={"_id": 0, "current_balance": 1},
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+            if not customer:
+                if await db.customers.find_one({"id": customer_id}, {"_id": 1}, session=session):
+                    raise HTTPException(status_code=400, detail="Guthaben reicht nicht aus")
+                raise HTTPException(status_code=404, detail="Kunde nicht gefunden")
+            await db.credit_transactions.insert_one(doc, session=session)
     
     return {
         "message": "Transaktion erstellt",
         "transaction_id": transaction.id,
-        "new_balance": new_balance
+        "new_balance": customer["current_balance"]
+    }
+
+@api_router.post("/customers/reconcile")
+async def reconcile_customer_balances(dry_run: bool = False, current_user: dict = Depends(require_admin)): # RBAC: Admin only
+    """Recompute every balance from credit_transactions and correct drifted customers.
+
+    One $group over all transactions, one read of all customers and one bulk write.
+    Customers are read before the aggregation and corrected only if their stored
+    balance is still the value that was read, so a credit arriving meanwhile is
+    never overwritten (the customer is reported as skipped instead).
+    """
+    customers = await db.customers.find(
+        {}, {"_id": 0, "id": 1, "first_name": 1, "last_name": 1, "current_balance": 1}
+    ).to_list(None)
+    totals = await db.credit_transactions.aggregate([
+        {"$group": {"_id": "$customer_id", "balance": {"$sum": "$amount"}}}
+    ]).to_list(None)
+    actual = {t["_id"]: t["balance"] for t in totals}
+    
+    drift = []
+    operations = []
+    for c in customers:
+        stored = c.get("current_balance", 0)
+        expected = actual.get(c["id"], 0.0)
+        if abs(stored - expected) <= 0.005:
+            continue
+        drift.append({
+            "id": c["id"],
+            "name": f"{c.get('first_name', '')} {c.get('last_name', '')}",
+            "stored_balance": stored,
+            "actual_balance": expected,
+            "difference": expected - stored
+        })
+        operations.append(UpdateOne(
+            {"id": c["id"], "current_balance": c.get("current_balance")},
+            {"$set": {"current_balance": expected}}
+        ))
+    
+    corrected = 0
+    if operations and not dry_run:
+        result = await db.customers.bulk_write(operations, ordered=False)
+        corrected = result.modified_count
+    
+    known_ids = {c["id"] for c in customers}
+    return {
+        "checked": len(customers),
+        "drifted": len(drift),
+        "corrected": corrected,
+        "skipped": 0 if dry_run else len(drift) - corrected,
+        "total_difference": sum(d["difference"] for d in drift),
+        "orphaned_customer_ids": sorted(cid for cid in actual if cid not in known_ids),
+        "drift": sorted(drift, key=lambda d: -abs(d["difference"]))
     }
 
 @api_router.get("/customers/export/excel")
@@ -1259,12 +2511,205 @@ async def analyze_image(file: UploadFile = File(...), current_user: dict = Depen
         logger.error(f"Gemini Analysis Failed: {e}")
         raise HTTPException(status_code=500, detail=f"AI Analysis failed: {str(e)}")
 
+# ============== Database Indexes ==============
+# Every hot query filters on application ids or keys rather than _id. Provisioning
+# is idempotent: indexes that already exist are left alone, and one that cannot be
+# built (e.g. a unique index over existing duplicates) is reported, not fatal.
+
+DATABASE_INDEXES = [
+    ("customers", [("id", 1)], {"unique": True}),
+    # Blank emails are not covered, so they may repeat
+    ("customers", [("email", 1)], {"unique": True, "partialFilterExpression": {"email": {"$gt": ""}}}),
+    ("customers", [("last_name", 1), ("id", 1)], {}),
+    ("customers", [("search_keys", 1)], {}),
+    ("credit_transactions", [("customer_id", 1), ("timestamp", -1), ("id", -1)], {}),
+    ("credit_transactions", [("short_id", 1)], {"sparse": True}),
+    ("balance_checkpoints", [("customer_id", 1), ("as_of", -1)], {}),
+    ("purchases", [("id", 1)], {"unique": True}),
+    # Not unique: purchases from before short_id was kept unique may share one
+    ("purchases", [("short_id", 1)], {}),
+    # Unique for purchases marked short_id_unique, i.e. all written since; descending so
+    # its key pattern differs from the lookup index above
+    ("purchases", [("short_id", -1)], {"unique": True, "partialFilterExpression": {"short_id_unique": True}}),
+    ("purchases", [("deleted", 1), ("timestamp", -1), ("id", -1)], {}),
+    # Multikey: lets the per-checkout price suggestion refresh find the purchases of a cell
+    ("purchases", [(f"items.{field}", 1) for field in MATRIX_KEY_FIELDS], {}),
+    ("price_matrix", [(field, 1) for field in MATRIX_KEY_FIELDS], {"unique": True}),
+    ("price_matrix", [("version", 1)], {}),
+    ("custom_categories", [("name", 1)], {"unique": True}),
+    ("stats_rollups", [("period", 1), ("key", -1)], {}),
+    ("idempotency_keys", [("key", 1)], {"unique": True}),
+    ("idempotency_keys", [("created_at", 1)], {"expireAfterSeconds": IDEMPOTENCY_KEY_TTL_SECONDS}),
+    ("app_settings", [("type", 1)], {"unique": True}),
+]
+
+def index_name(keys: list) -> str:
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+async def ensure_indexes() -> dict:
+    """Create missing indexes and report what was created, already present or failed."""
+    report = {"created": [], "existing": [], "failed": []}
+    existing = {}
+    for collection_name, keys, options in DATABASE_INDEXES:
+        collection = db[collection_name]
+        if collection_name not in existing:
+            existing[collection_name] = set(await collection.index_information())
+        name = index_name(keys)
+        label = f"{collection_name}.{name}"
+        if name in existing[collection_name]:
+            report["existing"].append(label)
+            continue
+        try:
+            await collection.create_index(keys, name=name, **options)
+            report["created"].append(label)
+        except OperationFailure as e:
+            logger.error(f"Index {label} could not be created: {e}")
+            report["failed"].append({"index": label, "error": str(e)})
+    return report
+
+# ============== Database Migrations ==============
+
+TIMESTAMPED_COLLECTIONS = ("purchases", "credit_transactions")
+
+async def migrate_timestamps_to_dates() -> dict:
+    """One-time: convert ISO-string timestamps left by older versions to BSON dates."""
+    report = {}
+    for collection_name in TIMESTAMPED_COLLECTIONS:
+        collection = db[collection_name]
+        docs = await collection.find(
+            {"timestamp": {"$type": "string"}}, {"_id": 1, "timestamp": 1, "customer_id": 1}
+        ).to_list(None)
+        operations, unparseable = [], []
+        for doc in docs:
+            try:
+                operations.append(UpdateOne(
+                    {"_id": doc["_id"], "timestamp": doc["timestamp"]},
+                    {"$set": {"timestamp": parse_timestamp(doc["timestamp"])}}
+                ))
+            except ValueError:
+                unparseable.append(str(doc["_id"]))
+        converted = 0
+        if operations:
+            result = await collection.bulk_write(operations, ordered=False)
+            converted = result.modified_count
+        report[collection_name] = {"converted": converted, "unparseable": unparseable}
+        if collection_name == "credit_transactions" and converted:
+            # Balance checkpoints never include string-dated rows and add them on top instead.
+            # Once dated, rows older than a checkpoint would fall out of the balance, so the
+            # affected customers' checkpoints are dropped and rebuilt on the next balance read.
+            customer_ids = list({doc["customer_id"] for doc in docs if doc.get("customer_id")})
+            result = await db.balance_checkpoints.delete_many({"customer_id": {"$in": customer_ids}})
+            report[collection_name]["checkpoints_dropped"] = result.deleted_count
+    return report
+
+async def backfill_short_ids() -> dict:
+    """Store short_id on purchases and purchase credits created before it existed."""
+    purchases = await db.purchases.update_many(
+        {"short_id": {"$exists": False}},
+        [{"$set": {"short_id": {"$toUpper": {"$substrCP": ["$id", 0, 8]}}}}]
+    )
+    credits = await db.credit_transactions.update_many(
+        {"short_id": {"$exists": False}, "type": "purchase_credit", "reference_id": {"$type": "string"}},
+        [{"$set": {"short_id": {"$toUpper": {"$substrCP": ["$reference_id", 0, 8]}}}}]
+    )
+    return {"purchases": purchases.modified_count, "credit_transactions": credits.modified_count}
+
 # ============== App Setup ==============
 
 app.include_router(api_router)
 
 
+@app.on_event("startup")
+async def load_price_matrix_cache():
+    try:
+        await reload_price_matrix_cache()
+    except Exception as e:
+        # Lookups load the cache lazily, so a slow database must not block startup
+        logger.error(f"Price matrix cache could not be loaded at startup: {e}")
+
+@app.on_event("startup")
+async def load_price_suggestion_index():
+    try:
+        await load_price_suggestions()
+        # First start on an existing shop: build suggestions from the purchase history
+        if not price_suggestion_index and await db.purchases.find_one({"deleted": {"$ne": True}}, {"_id": 1}):
+            cells = await rebuild_price_suggestions()
+            logger.info(f"Built price suggestions for {cells} cells")
+    except Exception as e:
+        logger.error(f"Price suggestions could not be loaded at startup: {e}")
+
+@app.on_event("startup")
+async def provision_indexes():
+    try:
+        report = await ensure_indexes()
+        if report["created"]:
+            logger.info(f"Created indexes: {', '.join(report['created'])}")
+    except Exception as e:
+        logger.error(f"Indexes could not be provisioned at startup: {e}")
+
+@app.on_event("startup")
+async def convert_legacy_timestamps():
+    try:
+        report = await migrate_timestamps_to_dates()
+        for collection_name, result in report.items():
+            if result["converted"] or result["unparseable"]:
+                logger.info(f"Timestamp migration on {collection_name}: {result}")
+    except Exception as e:
+        logger.error(f"Timestamp migration failed: {e}")
+
+@app.on_event("startup")
+async def store_short_ids():
+    try:
+        report = await backfill_short_ids()
+        if any(report.values()):
+            logger.info(f"Stored receipt numbers: {report}")
+    except Exception as e:
+        logger.error(f"Receipt number backfill failed: {e}")
+
+@app.on_event("startup")
+async def backfill_stats_rollups():
+    try:
+        if not await db.stats_rollups.find_one({}, {"_id": 1}) and await db.purchases.find_one({}, {"_id": 1}):
+            documents = await rebuild_stats_rollups()
+            logger.info(f"Built {documents} stats rollups")
+    except Exception as e:
+        logger.error(f"Stats rollups could not be built at startup: {e}")
+
+@app.on_event("startup")
+async def seed_today_tally():
+    try:
+        await today_tally.seed()
+    except Exception as e:
+        # The first request seeds it instead
+        logger.error(f"Today tally could not be seeded at startup: {e}")
+
+@app.on_event("startup")
+async def prepare_customer_search():
+    try:
+        backfilled = await backfill_customer_search_keys()
+        if backfilled:
+            logger.info(f"Added search keys to {backfilled} customers")
+    except Exception as e:
+        logger.error(f"Customer search keys could not be prepared: {e}")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+
+
+# ============== CLI ==============
+# Maintenance commands, e.g. `python server.py ensure-indexes`
+
+CLI_COMMANDS = {
+    "ensure-indexes": ensure_indexes,
+    "migrate-timestamps": migrate_timestamps_to_dates,
+    "backfill-short-ids": backfill_short_ids,
+    "rebuild-stats-rollups": rebuild_stats_rollups,
+    "rebuild-price-suggestions": rebuild_price_suggestions,
+}
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 2 or sys.argv[1] not in CLI_COMMANDS:
+        sys.exit(f"Usage: python server.py [{' | '.join(CLI_COMMANDS)}]")
+    print(json.dumps(asyncio.run(CLI_COMMANDS[sys.argv[1]]()), indent=2, default=str))
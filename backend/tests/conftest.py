@@ -0,0 +1,59 @@
+import os
+import sys
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import MagicMock, AsyncMock
+
+# server.py is imported lazily: the security test modules install their own
+# motor mocks at import time, and the module is only ever imported once.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def server():
+    os.environ.setdefault("JWT_SECRET", "test-secret")
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "test_db")
+    import server as server_module
+    return server_module
+
+
+@pytest.fixture
+def client(server):
+    return TestClient(server.app)
+
+
+def get_auth_headers(server, username, role):
+    token = server.create_access_token(username, role)
+    return {"Authorization": f"Bearer {token}"}
+
+
+def make_cursor(docs):
+    cursor = MagicMock()
+    cursor.to_list = AsyncMock(return_value=docs)
+    cursor.sort = MagicMock(return_value=cursor)
+    cursor.limit = MagicMock(return_value=cursor)
+    return cursor
+
+
+class FakeSession:
+    """Stands in for a motor client session and its transaction context."""
+
+    def __init__(self):
+        self.aborted = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.aborted = exc_type is not None
+        return False
+
+    def start_transaction(self):
+        return self
+
+
+def make_mongo_client(session):
+    mongo_client = MagicMock()
+    mongo_client.start_session = AsyncMock(return_value=session)
+    return mongo_client
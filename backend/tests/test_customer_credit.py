@@ -0,0 +1,221 @@
+from unittest.mock import MagicMock, AsyncMock, patch
+from conftest import get_auth_headers, make_cursor, FakeSession, make_mongo_client
+
+
+class TestPurchaseCredit:
+
+    ITEMS = [{"category": "Jeans", "price_level": "Mittel", "condition": "Neu", "relevance": "Wichtig", "price": 12.5}]
+
+    def test_credit_uses_atomic_increment_in_transaction(self, server, client):
+        session = FakeSession()
+        fake_db = MagicMock()
+        fake_db.customers.find_one_and_update = AsyncMock(return_value={"first_name": "Anna", "last_name": "Muster"})
+        fake_db.credit_transactions.insert_one = AsyncMock()
+        fake_db.purchases.find_one = AsyncMock(return_value=None)
+        fake_db.purchases.insert_one = AsyncMock()
+        fake_db.stats_rollups.bulk_write = AsyncMock()
+        with patch.object(server, "db", fake_db), patch.object(server, "client", make_mongo_client(session)), \
+                patch.object(server, "schedule_price_suggestion_refresh"):
+            response = client.post("/api/purchases", json={"items": self.ITEMS, "credit_customer_id": "c1"},
+                                   headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+
+        assert response.status_code == 200
+        assert response.json()["credit_customer_name"] == "Anna Muster"
+        args, kwargs = fake_db.customers.find_one_and_update.call_args
+        assert args[1] == {"$inc": {"current_balance": 12.5}}
+        assert kwargs["session"] is session
+        assert fake_db.credit_transactions.insert_one.call_args.kwargs["session"] is session
+        assert fake_db.purchases.insert_one.call_args.kwargs["session"] is session
+        assert fake_db.stats_rollups.bulk_write.call_args.kwargs["session"] is session
+        fake_db.customers.find_one.assert_not_called()
+        fake_db.customers.update_one.assert_not_called()
+
+    def test_unknown_customer_aborts_transaction(self, server, client):
+        session = FakeSession()
+        fake_db = MagicMock()
+        fake_db.customers.find_one_and_update = AsyncMock(return_value=None)
+        fake_db.purchases.find_one = AsyncMock(return_value=None)
+        fake_db.purchases.insert_one = AsyncMock()
+        with patch.object(server, "db", fake_db), patch.object(server, "client", make_mongo_client(session)):
+            response = client.post("/api/purchases", json={"items": self.ITEMS, "credit_customer_id": "missing"},
+                                   headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+
+        assert response.status_code == 404
+        assert session.aborted
+        fake_db.purchases.insert_one.assert_not_called()
+
+
+class TestManualTransactions:
+
+    def post_transaction(self, server, client, fake_db, payload):
+        with patch.object(server, "db", fake_db), patch.object(server, "client", make_mongo_client(FakeSession())):
+            return client.post("/api/customers/c1/transactions", json=payload,
+                               headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+
+    def test_debit_is_guarded_and_returns_new_balance(self, server, client):
+        fake_db = MagicMock()
+        fake_db.customers.find_one_and_update = AsyncMock(return_value={"current_balance": 30.0})
+        fake_db.credit_transactions.insert_one = AsyncMock()
+
+        response = self.post_transaction(server, client, fake_db, {"amount": 20, "type": "debit"})
+
+        assert response.status_code == 200
+        assert response.json()["new_balance"] == 30.0
+        query, update = fake_db.customers.find_one_and_update.call_args.args
+        assert query == {"id": "c1", "current_balance": {"$gte": 20}}
+        assert update == {"$inc": {"current_balance": -20}}
+        assert fake_db.credit_transactions.insert_one.call_args.args[0]["staff_username"] == "smilla"
+
+    def test_overdraw_is_rejected(self, server, client):
+        fake_db = MagicMock()
+        fake_db.customers.find_one_and_update = AsyncMock(return_value=None)
+        fake_db.customers.find_one = AsyncMock(return_value={"_id": "x"})
+        fake_db.credit_transactions.insert_one = AsyncMock()
+
+        response = self.post_transaction(server, client, fake_db, {"amount": 500, "type": "debit"})
+
+        assert response.status_code == 400
+        fake_db.credit_transactions.insert_one.assert_not_called()
+
+
+class TestBalanceCheckpoints:
+
+    def make_db(self, checkpoint, aggregated):
+        fake_db = MagicMock()
+        fake_db.balance_checkpoints.find_one = AsyncMock(return_value=checkpoint)
+        fake_db.balance_checkpoints.insert_one = AsyncMock()
+        fake_db.credit_transactions.aggregate = MagicMock(return_value=make_cursor(aggregated))
+        return fake_db
+
+    def test_balance_is_checkpoint_plus_newer_transactions(self, server):
+        import asyncio
+        from datetime import datetime
+        as_of = datetime(2026, 1, 1)
+        fake_db = self.make_db(
+            {"customer_id": "c1", "balance": 100.0, "transaction_count": 1200, "as_of": as_of},
+            [{"total": 25.0, "count": 3, "settled_total": 5.0, "settled_count": 1}],
+        )
+        with patch.object(server, "db", fake_db):
+            ledger = asyncio.run(server.compute_customer_balance("c1"))
+
+        assert ledger == {"balance": 125.0, "transaction_count": 1203}
+        match = fake_db.credit_transactions.aggregate.call_args.args[0][0]["$match"]
+        assert match["$or"][0] == {"timestamp": {"$gt": as_of}}
+        fake_db.balance_checkpoints.insert_one.assert_not_called()
+
+    def test_new_checkpoint_after_interval(self, server):
+        import asyncio
+        count = server.BALANCE_CHECKPOINT_INTERVAL
+        fake_db = self.make_db(None, [{"total": 40.0, "count": count + 2, "settled_total": 30.0, "settled_count": count}])
+        with patch.object(server, "db", fake_db):
+            ledger = asyncio.run(server.compute_customer_balance("c1"))
+
+        assert ledger["balance"] == 40.0
+        checkpoint = fake_db.balance_checkpoints.insert_one.call_args.args[0]
+        assert (checkpoint["balance"], checkpoint["transaction_count"]) == (30.0, count)
+
+
+class TestReconciliation:
+
+    def test_reconcile_reports_and_corrects_drift(self, server, client):
+        fake_db = MagicMock()
+        fake_db.customers.find = MagicMock(return_value=make_cursor([
+            {"id": "c1", "first_name": "Anna", "last_name": "Muster", "current_balance": 50.0},
+            {"id": "c2", "first_name": "Ben", "last_name": "Beispiel", "current_balance": 10.0},
+            {"id": "c3", "first_name": "Cleo", "last_name": "Test", "current_balance": 5.0},
+        ]))
+        fake_db.credit_transactions.aggregate = MagicMock(return_value=make_cursor([
+            {"_id": "c1", "balance": 50.0},
+            {"_id": "c2", "balance": 12.5},
+            {"_id": "gone", "balance": 7.0},
+        ]))
+        fake_db.customers.bulk_write = AsyncMock(return_value=MagicMock(modified_count=2))
+        with patch.object(server, "db", fake_db):
+            response = client.post("/api/customers/reconcile", headers=get_auth_headers(server, "admin", "admin"))
+
+        report = response.json()
+        assert (report["checked"], report["drifted"], report["corrected"]) == (3, 2, 2)
+        assert [d["id"] for d in report["drift"]] == ["c3", "c2"]
+        assert report["orphaned_customer_ids"] == ["gone"]
+        operations = fake_db.customers.bulk_write.call_args.args[0]
+        assert operations[0]._filter == {"id": "c2", "current_balance": 10.0}
+        assert operations[1]._doc == {"$set": {"current_balance": 0.0}}
+
+    def test_customer_view_heals_balance_only_if_unchanged(self, server, client):
+        fake_db = MagicMock()
+        fake_db.customers.find_one = AsyncMock(return_value={"id": "c1", "current_balance": 10.0})
+        fake_db.customers.update_one = AsyncMock()
+        page = {"transactions": [], "next_cursor": None}
+        with patch.object(server, "db", fake_db), \
+                patch.object(server, "compute_customer_balance", AsyncMock(return_value={"balance": 12.5, "transaction_count": 2})), \
+                patch.object(server, "get_customer_transactions", AsyncMock(return_value=page)):
+            response = client.get("/api/customers/c1", headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+
+        assert response.json()["current_balance"] == 12.5
+        fake_db.customers.update_one.assert_awaited_once_with(
+            {"id": "c1", "current_balance": 10.0}, {"$set": {"current_balance": 12.5}}
+        )
+
+
+class TestCustomerSearch:
+
+    def test_search_keys_cover_umlaut_spellings(self, server):
+        keys = server.customer_search_keys("Zoë", "Müller", "Z.Mueller@Example.ch")
+        assert {"mueller", "muller", "zoe", "zoe mueller", "z.mueller"} <= set(keys)
+        assert server.normalize_search_text("MÜLLER") == "mueller"
+
+    def test_query_uses_anchored_prefixes(self, server):
+        query = server.customer_search_query("Anna Mül")
+        patterns = [p.pattern for p in query["search_keys"]["$all"]]
+        assert patterns == ["^anna", "^muel"]
+        assert server.customer_search_query("   ") == {}
+
+    def test_typeahead_returns_slim_matches(self, server, client):
+        fake_db = MagicMock()
+        cursor = make_cursor([{"id": "c1", "first_name": "Anna", "last_name": "Müller", "current_balance": 5.0}])
+        fake_db.customers.find = MagicMock(return_value=cursor)
+        with patch.object(server, "db", fake_db):
+            response = client.get("/api/customers/typeahead", params={"q": "mue", "limit": 5},
+                                  headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+
+        assert response.status_code == 200
+        assert response.json() == [{"id": "c1", "name": "Anna Müller", "current_balance": 5.0}]
+        query, projection = fake_db.customers.find.call_args[0]
+        assert "search_keys" in query
+        assert set(projection) == {"_id", "id", "first_name", "last_name", "current_balance"}
+        cursor.limit.assert_called_once_with(5)
+
+
+class TestCursorPagination:
+
+    def test_cursor_round_trips_datetimes(self, server):
+        stamp = server.datetime(2024, 5, 1, 12, 30, tzinfo=server.timezone.utc)
+        assert server.decode_cursor(server.encode_cursor(stamp, "t1")) == (stamp, "t1")
+        assert server.keyset_filter("timestamp", server.encode_cursor(stamp, "t1"), descending=True) == {
+            "$or": [{"timestamp": {"$lt": stamp}}, {"timestamp": stamp, "id": {"$lt": "t1"}}]
+        }
+
+    def test_customer_list_returns_next_cursor(self, server, client):
+        fake_db = MagicMock()
+        docs = [{"id": f"c{i}", "first_name": "A", "last_name": f"N{i}", "email": "", "current_balance": 0}
+                for i in range(3)]
+        cursor = make_cursor(docs)
+        fake_db.customers.find = MagicMock(return_value=cursor)
+        headers = get_auth_headers(server, "smilla", "mitarbeiter")
+        with patch.object(server, "db", fake_db):
+            first = client.get("/api/customers", params={"limit": 2}, headers=headers)
+            second = client.get("/api/customers", params={"limit": 2, "cursor": first.json()["next_cursor"]},
+                                headers=headers)
+
+        assert [c["id"] for c in first.json()["customers"]] == ["c0", "c1"]
+        cursor.sort.assert_called_with([("last_name", 1), ("id", 1)])
+        cursor.limit.assert_called_with(3)
+        assert second.status_code == 200
+        query = fake_db.customers.find.call_args[0][0]
+        assert query == {"$or": [{"last_name": {"$gt": "N1"}}, {"last_name": "N1", "id": {"$gt": "c1"}}]}
+
+    def test_invalid_cursor_is_rejected(self, server, client):
+        with patch.object(server, "db", MagicMock()):
+            response = client.get("/api/customers/c1/transactions", params={"cursor": "nonsense"},
+                                  headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+        assert response.status_code == 400
@@ -0,0 +1,116 @@
+import asyncio
+import pytest
+from unittest.mock import MagicMock, AsyncMock, patch
+from pymongo.errors import DuplicateKeyError
+
+
+def make_index_db(existing):
+    """A fake database whose collections already hold the given index names."""
+    collections = {}
+
+    def collection(name):
+        if name not in collections:
+            coll = MagicMock()
+            coll.index_information = AsyncMock(return_value={"_id_": {}, **{n: {} for n in existing.get(name, ())}})
+            coll.create_index = AsyncMock()
+            collections[name] = coll
+        return collections[name]
+
+    fake_db = MagicMock()
+    fake_db.__getitem__.side_effect = collection
+    return fake_db, collections
+
+
+class TestEnsureIndexes:
+
+    def test_creates_only_missing_indexes(self, server):
+        fake_db, collections = make_index_db({"customers": ["id_1"]})
+        with patch.object(server, "db", fake_db):
+            report = asyncio.run(server.ensure_indexes())
+
+        assert "customers.id_1" in report["existing"]
+        assert "customers.email_1" in report["created"]
+        assert "price_matrix.category_1_price_level_1_condition_1_relevance_1" in report["created"]
+        assert "purchases.items.category_1_items.price_level_1_items.condition_1_items.relevance_1" in report["created"]
+        assert len(report["created"]) + len(report["existing"]) == len(server.DATABASE_INDEXES)
+        kwargs = collections["customers"].create_index.call_args_list[0].kwargs
+        assert kwargs["name"] == "email_1" and kwargs["unique"] is True
+
+    def test_failed_index_is_reported(self, server):
+        fake_db, _ = make_index_db({})
+        fake_db["app_settings"].create_index.side_effect = DuplicateKeyError("E11000 duplicate key")
+        with patch.object(server, "db", fake_db):
+            report = asyncio.run(server.ensure_indexes())
+
+        assert report["failed"] == [{"index": "app_settings.type_1", "error": "E11000 duplicate key"}]
+        assert len(report["created"]) == len(server.DATABASE_INDEXES) - 1
+
+
+class TestTimestamps:
+
+    def test_date_filters_become_datetimes(self, server):
+        utc = server.timezone.utc
+        # Bare dates are shop days: Zurich midnight is 22:00 UTC in summer
+        assert server.timestamp_range("2024-05-01", "2024-05-31") == {
+            "$gte": server.datetime(2024, 4, 30, 22, tzinfo=utc),
+            "$lt": server.datetime(2024, 5, 31, 22, tzinfo=utc),
+        }
+        # The day DST ends has 25 hours
+        assert server.timestamp_range(None, "2024-10-27") == {"$lt": server.datetime(2024, 10, 27, 23, tzinfo=utc)}
+        assert server.timestamp_range("2024-01-15T08:30:00", None) == {"$gte": server.datetime(2024, 1, 15, 7, 30, tzinfo=utc)}
+        assert server.timestamp_range(None, "2024-05-31T12:00:00Z") == {"$lte": server.datetime(2024, 5, 31, 12, tzinfo=utc)}
+        # Stored legacy strings without offset are still UTC
+        assert server.parse_timestamp("2024-05-31T12:00:00") == server.datetime(2024, 5, 31, 12, tzinfo=utc)
+
+    def test_invalid_date_is_rejected(self, server):
+        with pytest.raises(server.HTTPException) as exc:
+            server.timestamp_range("31.05.2024", None)
+        assert exc.value.status_code == 400
+
+    def test_migration_converts_string_timestamps(self, server):
+        fake_db = MagicMock()
+        purchases = MagicMock()
+        cursor = MagicMock()
+        cursor.to_list = AsyncMock(return_value=[
+            {"_id": 1, "timestamp": "2023-01-01T12:00:00+00:00"},
+            {"_id": 2, "timestamp": "gestern"},
+        ])
+        purchases.find = MagicMock(return_value=cursor)
+        purchases.bulk_write = AsyncMock(return_value=MagicMock(modified_count=1))
+        transactions = MagicMock()
+        empty = MagicMock()
+        empty.to_list = AsyncMock(return_value=[])
+        transactions.find = MagicMock(return_value=empty)
+        fake_db.__getitem__.side_effect = {"purchases": purchases, "credit_transactions": transactions}.get
+        with patch.object(server, "db", fake_db):
+            report = asyncio.run(server.migrate_timestamps_to_dates())
+
+        assert report == {
+            "purchases": {"converted": 1, "unparseable": ["2"]},
+            "credit_transactions": {"converted": 0, "unparseable": []},
+        }
+        (operation,) = purchases.bulk_write.call_args[0][0]
+        assert operation._doc == {"$set": {"timestamp": server.datetime(2023, 1, 1, 12, tzinfo=server.timezone.utc)}}
+        transactions.bulk_write.assert_not_called()
+
+    def test_migration_drops_checkpoints_of_converted_customers(self, server):
+        fake_db = MagicMock()
+        purchases = MagicMock()
+        empty = MagicMock()
+        empty.to_list = AsyncMock(return_value=[])
+        purchases.find = MagicMock(return_value=empty)
+        transactions = MagicMock()
+        cursor = MagicMock()
+        cursor.to_list = AsyncMock(return_value=[
+            {"_id": 1, "timestamp": "2023-01-01T12:00:00", "customer_id": "c1"},
+            {"_id": 2, "timestamp": "2023-01-02T12:00:00", "customer_id": "c1"},
+        ])
+        transactions.find = MagicMock(return_value=cursor)
+        transactions.bulk_write = AsyncMock(return_value=MagicMock(modified_count=2))
+        fake_db.__getitem__.side_effect = {"purchases": purchases, "credit_transactions": transactions}.get
+        fake_db.balance_checkpoints.delete_many = AsyncMock(return_value=MagicMock(deleted_count=3))
+        with patch.object(server, "db", fake_db):
+            report = asyncio.run(server.migrate_timestamps_to_dates())
+
+        assert report["credit_transactions"]["checkpoints_dropped"] == 3
+        fake_db.balance_checkpoints.delete_many.assert_called_once_with({"customer_id": {"$in": ["c1"]}})
@@ -0,0 +1,454 @@
+import time
+import numpy as np
+from unittest.mock import MagicMock, AsyncMock, patch
+from conftest import get_auth_headers, make_cursor
+
+
+def make_db(price_matrix=(), custom_categories=(), version=0):
+    fake_db = MagicMock()
+    fake_db.price_matrix.find = MagicMock(return_value=make_cursor(list(price_matrix)))
+    fake_db.custom_categories.find = MagicMock(return_value=make_cursor(list(custom_categories)))
+    fake_db.app_settings.find_one = AsyncMock(return_value={"version": version})
+    fake_db.app_settings.update_one = AsyncMock()
+    fake_db.app_settings.find_one_and_update = AsyncMock(return_value={"type": "price_matrix", "version": version + 1})
+    fake_db.pricing_rules.find_one = AsyncMock(return_value=None)
+    return fake_db
+
+
+class TestPriceMatrixCache:
+
+    def test_dense_lookup(self, server):
+        entries = [
+            {"category": "Jeans", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig", "fixed_price": 25},
+            {"category": "Jeans", "price_level": "Mittel", "condition": "Neu", "relevance": "Wichtig", "fixed_price": None},
+            {"category": "Unbekannt", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig", "fixed_price": 99},
+        ]
+        cache = server.PriceMatrixCache(server.CATEGORIES + ["Taschen"], entries)
+
+        assert cache.prices.shape == (len(server.CATEGORIES) + 1, 4, 4, 3)
+        assert cache.lookup("Jeans", "Luxus", "Neu", "Wichtig") == 25.0
+        assert cache.lookup("Jeans", "Mittel", "Neu", "Wichtig") is None
+        assert cache.lookup("Taschen", "Luxus", "Neu", "Wichtig") is None
+        assert cache.lookup("Unbekannt", "Luxus", "Neu", "Wichtig") is None
+        # Read-only so a swapped-out cache can never be changed under a reader
+        assert not cache.prices.flags.writeable
+
+    def test_lookup_endpoint_uses_cache(self, server, client):
+        cache = server.PriceMatrixCache(server.CATEGORIES, [
+            {"category": "Hosen", "price_level": "Teuer", "condition": "Neu", "relevance": "Wichtig", "fixed_price": 12.5},
+        ])
+        fake_db = MagicMock()
+        with patch.object(server, "db", fake_db), patch.object(server, "price_matrix_cache", cache):
+            response = client.get(
+                "/api/price-matrix/lookup",
+                params={"category": "Hosen", "price_level": "Teuer", "condition": "Neu", "relevance": "Wichtig"},
+                headers=get_auth_headers(server, "smilla", "mitarbeiter"),
+            )
+        assert response.status_code == 200
+        assert response.json() == {"fixed_price": 12.5, "found": True}
+        fake_db.price_matrix.find_one.assert_not_called()
+
+    def test_batch_lookup_preserves_order(self, server, client):
+        cache = server.PriceMatrixCache(server.CATEGORIES, [
+            {"category": "Jeans", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig", "fixed_price": 30},
+        ])
+        items = [
+            {"category": "Hosen", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig"},
+            {"category": "Jeans", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig"},
+        ]
+        with patch.object(server, "price_matrix_cache", cache):
+            response = client.post(
+                "/api/price-matrix/lookup/batch",
+                json={"items": items},
+                headers=get_auth_headers(server, "smilla", "mitarbeiter"),
+            )
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [r["found"] for r in results] == [False, True]
+        assert results[1]["fixed_price"] == 30.0
+        assert results[1]["category"] == "Jeans"
+
+
+class TestPriceMatrixUpload:
+
+    def test_validation_rejects_rows_and_dedupes(self, server):
+        import pandas as pd
+        df = pd.DataFrame({
+            "Kategorie": ["Jeans", "Jeans", "Taschen", "Hosen"],
+            "Preisniveau": ["Luxus", "Luxus", "Luxus", "Mittel"],
+            "Zustand": ["Neu", "Neu", "Neu", "Neu"],
+            "Relevanz": ["Wichtig", "Wichtig", "Wichtig", "Wichtig"],
+            "Fixpreis": [10, 12, 5, "zehn"],
+        })
+        valid, rejected = server.validate_price_matrix_frame(df, server.CATEGORIES)
+
+        assert len(valid) == 1
+        assert valid.iloc[0]["fixed_price"] == 12
+        assert [r["row"] for r in rejected] == [4, 5]
+
+    def test_streaming_reader_keeps_sheet_row_numbers(self, server):
+        import io
+        from openpyxl import Workbook
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.append(["Kategorie", "Preisniveau", "Zustand", "Relevanz", "Fixpreis", "Notiz"])
+        sheet.append(["Jeans", "Luxus", "Neu", "Wichtig", 15, "ok"])
+        sheet.append([None, None, None, None, None, None])
+        sheet.append(["Taschen", "Luxus", "Neu", "Wichtig", 5, None])
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+
+        df = server.read_price_matrix_workbook(buffer.getvalue())
+        assert list(df.columns) == ["Kategorie", "Preisniveau", "Zustand", "Relevanz", "Fixpreis"]
+        assert len(df) == 2
+
+        _, rejected = server.validate_price_matrix_frame(df, server.CATEGORIES)
+        assert rejected == [{"row": 4, "reason": "Ungültiger Wert für Kategorie"}]
+
+    def test_text_formats_parse_to_the_same_columns(self, server):
+        csv_content = "Kategorie;Preisniveau;Zustand;Relevanz;Fixpreis\nJeans;Luxus;Neu;Wichtig;12.5\nJeans;Teuer;Neu;Wichtig;\n"
+        ndjson_content = (
+            '{"Kategorie": "Jeans", "Preisniveau": "Luxus", "Zustand": "Neu", "Relevanz": "Wichtig", "Fixpreis": 12.5}\n'
+            '{"Kategorie": "Jeans", "Preisniveau": "Teuer", "Zustand": "Neu", "Relevanz": "Wichtig", "Fixpreis": null}\n'
+        )
+        for fmt, content in (("csv", csv_content), ("ndjson", ndjson_content)):
+            df = server.read_price_matrix_text(content.encode("utf-8"), fmt)
+            valid, rejected = server.validate_price_matrix_frame(df, server.CATEGORIES)
+            assert rejected == []
+            assert valid["fixed_price"].iloc[0] == 12.5
+            assert valid["fixed_price"].isna().iloc[1]
+
+    def test_upload_uses_single_bulk_write(self, server, client):
+        import io
+        import pandas as pd
+        df = pd.DataFrame([
+            {"Kategorie": "Jeans", "Preisniveau": "Luxus", "Zustand": "Neu", "Relevanz": "Wichtig", "Fixpreis": 20},
+            {"Kategorie": "Jeans", "Preisniveau": "Teuer", "Zustand": "Neu", "Relevanz": "Wichtig", "Fixpreis": None},
+        ])
+        buffer = io.BytesIO()
+        df.to_excel(buffer, index=False)
+
+        fake_db = make_db()
+        fake_db.price_matrix.bulk_write = AsyncMock(
+            return_value=MagicMock(upserted_count=1, modified_count=0, matched_count=1)
+        )
+        with patch.object(server, "db", fake_db):
+            response = client.post(
+                "/api/price-matrix/upload",
+                files={"file": ("matrix.xlsx", buffer.getvalue(), "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")},
+                headers=get_auth_headers(server, "admin", "admin"),
+            )
+
+        assert response.status_code == 200
+        data = response.json()
+        assert (data["inserted"], data["modified"], data["unchanged"], data["rejected"]) == (1, 0, 1, 0)
+        operations = fake_db.price_matrix.bulk_write.call_args.args[0]
+        assert len(operations) == 2
+        fake_db.price_matrix.update_one.assert_not_called()
+        fake_db.app_settings.find_one_and_update.assert_awaited_once()
+
+
+class TestPriceMatrixDownload:
+
+    def test_download_is_cached_by_version(self, server, client):
+        import io
+        import pandas as pd
+        cache = server.PriceMatrixCache(server.CATEGORIES, [
+            {"category": "Jeans", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig", "fixed_price": 18},
+        ], version=7)
+        headers = get_auth_headers(server, "smilla", "mitarbeiter")
+        with patch.object(server, "price_matrix_cache", cache), patch.object(server, "price_matrix_renders", {}):
+            response = client.get("/api/price-matrix/download", headers=headers)
+            assert response.status_code == 200
+            etag = response.headers["etag"]
+            assert etag == '"preismatrix-v7.xlsx"'
+
+            df = pd.read_excel(io.BytesIO(response.content))
+            assert len(df) == len(server.CATEGORIES) * 4 * 4 * 3
+            row = df[(df["Kategorie"] == "Jeans") & (df["Preisniveau"] == "Luxus")
+                     & (df["Zustand"] == "Neu") & (df["Relevanz"] == "Wichtig")]
+            assert row.iloc[0]["Fixpreis"] == 18
+
+            with patch.object(server, "render_price_matrix") as render:
+                cached = client.get("/api/price-matrix/download", headers=headers)
+                not_modified = client.get("/api/price-matrix/download", headers={**headers, "If-None-Match": etag})
+                render.assert_not_called()
+            assert cached.content == response.content
+            assert not_modified.status_code == 304
+
+    def test_csv_and_ndjson_downloads_are_sanitized(self, server, client):
+        import io
+        import json
+        import pandas as pd
+        cache = server.PriceMatrixCache(["=Formel"], [
+            {"category": "=Formel", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig", "fixed_price": 9},
+        ], version=1)
+        headers = get_auth_headers(server, "smilla", "mitarbeiter")
+        with patch.object(server, "price_matrix_cache", cache), patch.object(server, "price_matrix_renders", {}):
+            csv_response = client.get("/api/price-matrix/download", params={"format": "csv"}, headers=headers)
+            ndjson_response = client.get("/api/price-matrix/download", headers={**headers, "Accept": "application/x-ndjson"})
+
+        assert csv_response.headers["content-type"].startswith("text/csv")
+        df = pd.read_csv(io.StringIO(csv_response.text))
+        assert list(df.columns) == ["Kategorie", "Preisniveau", "Zustand", "Relevanz", "Fixpreis"]
+        assert df.iloc[0]["Kategorie"] == "'=Formel"
+
+        rows = [json.loads(line) for line in ndjson_response.text.splitlines()]
+        assert len(rows) == 4 * 4 * 3
+        assert rows[0] == {"Kategorie": "'=Formel", "Preisniveau": "Luxus", "Zustand": "Neu",
+                           "Relevanz": "Stark relevant", "Fixpreis": None}
+        assert rows[1]["Fixpreis"] == 9
+
+
+class TestPriceMatrixDeltaSync:
+
+    def test_upserts_stamp_version_only_on_change(self, server):
+        import pandas as pd
+        valid = pd.DataFrame([{"category": "Jeans", "price_level": "Luxus", "condition": "Neu",
+                               "relevance": "Wichtig", "fixed_price": 20.0}])
+        (operation,) = server.price_matrix_upserts(valid, 5)
+        update = operation._doc[0]["$set"]
+        assert update["fixed_price"] == {"$literal": 20.0}
+        assert update["version"] == {"$cond": [{"$eq": ["$fixed_price", {"$literal": 20.0}]}, "$version", 5]}
+
+    def test_upserts_write_dollar_categories_literally(self, server):
+        import pandas as pd
+        valid = pd.DataFrame([{"category": "$Sale", "price_level": "Luxus", "condition": "Neu",
+                               "relevance": "Wichtig", "fixed_price": None}])
+        (operation,) = server.price_matrix_upserts(valid, 5)
+        assert operation._filter["category"] == "$Sale"
+        update = operation._doc[0]["$set"]
+        assert update["category"] == {"$literal": "$Sale"}
+        assert update["fixed_price"] == {"$literal": None}
+
+    def test_since_returns_changed_and_removed_cells(self, server, client):
+        changed = [
+            {"category": "Jeans", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig", "fixed_price": 20.0},
+            {"category": "Hosen", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig", "fixed_price": None},
+        ]
+        fake_db = make_db(price_matrix=changed)
+        fake_db.app_settings.find_one = AsyncMock(return_value={"type": "price_matrix", "version": 9, "cleared_version": 2})
+        cache = server.PriceMatrixCache(server.CATEGORIES, changed, version=9)
+        with patch.object(server, "db", fake_db), patch.object(server, "price_matrix_cache", cache):
+            response = client.get("/api/price-matrix", params={"since": 4},
+                                  headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["version"] == 9
+        assert data["reset"] is False
+        assert [e["category"] for e in data["changed"]] == ["Jeans"]
+        assert data["removed"] == [{"category": "Hosen", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig"}]
+        assert fake_db.price_matrix.find.call_args.args[0] == {"version": {"$gt": 4}}
+
+    def test_since_before_clear_forces_reset(self, server, client):
+        fake_db = make_db()
+        fake_db.app_settings.find_one = AsyncMock(return_value={"type": "price_matrix", "version": 9, "cleared_version": 6})
+        cache = server.PriceMatrixCache(server.CATEGORIES, [], version=9)
+        with patch.object(server, "db", fake_db), patch.object(server, "price_matrix_cache", cache):
+            response = client.get("/api/price-matrix", params={"since": 4},
+                                  headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+
+        assert response.json()["reset"] is True
+        fake_db.price_matrix.find.assert_not_called()
+
+    def test_rules_change_resets_with_effective_prices(self, server, client):
+        fake_db = make_db()
+        fake_db.app_settings.find_one = AsyncMock(return_value={"type": "price_matrix", "version": 9, "rules_version": 8})
+        rules = {"base_prices": {"Jeans": 10.0}, "rounding": 0.5}
+        explicit = [{"category": "Hosen", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig", "fixed_price": 30.0}]
+        cache = server.PriceMatrixCache(server.CATEGORIES, explicit, version=9, rules=rules)
+        with patch.object(server, "db", fake_db), patch.object(server, "price_matrix_cache", cache):
+            response = client.get("/api/price-matrix", params={"since": 7},
+                                  headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+
+        data = response.json()
+        assert data["reset"] is True
+        # Every Jeans cell from the rules plus the explicit Hosen cell
+        assert len(data["changed"]) == 4 * 4 * 3 + 1
+        assert {"category": "Hosen", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig",
+                "fixed_price": 30.0} in data["changed"]
+
+    def test_removed_override_falls_back_to_rule_price(self, server, client):
+        removed = {"category": "Jeans", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig"}
+        fake_db = make_db(price_matrix=[{**removed, "fixed_price": None}])
+        fake_db.app_settings.find_one = AsyncMock(return_value={"type": "price_matrix", "version": 9, "rules_version": 2})
+        cache = server.PriceMatrixCache(server.CATEGORIES, [], version=9, rules={"base_prices": {"Jeans": 10.0}})
+        with patch.object(server, "db", fake_db), patch.object(server, "price_matrix_cache", cache):
+            data = client.get("/api/price-matrix", params={"since": 4},
+                              headers=get_auth_headers(server, "smilla", "mitarbeiter")).json()
+
+        assert data["reset"] is False
+        assert data["changed"] == [{**removed, "fixed_price": 10.0}]
+        assert data["removed"] == []
+
+    def test_compact_format_is_flat_in_axis_order(self, server, client):
+        cache = server.PriceMatrixCache(server.CATEGORIES, [
+            {"category": "Hosen", "price_level": "Mittel", "condition": "Abgenutzt", "relevance": "Nicht beliebt", "fixed_price": 4.5},
+        ], version=3)
+        with patch.object(server, "price_matrix_cache", cache):
+            response = client.get("/api/price-matrix", params={"format": "compact"},
+                                  headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+
+        data = response.json()
+        axes = data["axes"]
+        assert len(data["prices"]) == len(axes["categories"]) * 4 * 4 * 3
+        c, l, k, r = (axes["categories"].index("Hosen"), axes["price_levels"].index("Mittel"),
+                      axes["conditions"].index("Abgenutzt"), axes["relevance_levels"].index("Nicht beliebt"))
+        index = ((c * len(axes["price_levels"]) + l) * len(axes["conditions"]) + k) * len(axes["relevance_levels"]) + r
+        assert data["prices"][index] == 4.5
+        assert sum(p is not None for p in data["prices"]) == 1
+
+
+class TestPriceMatrixDryRun:
+
+    def test_dry_run_diff_then_apply(self, server, client):
+        csv_content = (
+            "Kategorie,Preisniveau,Zustand,Relevanz,Fixpreis\n"
+            "Jeans,Luxus,Neu,Wichtig,25\n"      # changed 20 -> 25
+            "Jeans,Teuer,Neu,Wichtig,15\n"      # added
+            "Hosen,Luxus,Neu,Wichtig,\n"        # removed
+            "Hosen,Teuer,Neu,Wichtig,8\n"       # unchanged
+            "Taschen,Teuer,Neu,Wichtig,8\n"     # invalid
+        )
+        cache = server.PriceMatrixCache(server.CATEGORIES, [
+            {"category": "Jeans", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig", "fixed_price": 20},
+            {"category": "Hosen", "price_level": "Luxus", "condition": "Neu", "relevance": "Wichtig", "fixed_price": 10},
+            {"category": "Hosen", "price_level": "Teuer", "condition": "Neu", "relevance": "Wichtig", "fixed_price": 8},
+        ], version=4)
+        fake_db = make_db(version=4)
+        fake_db.price_matrix.bulk_write = AsyncMock(
+            return_value=MagicMock(upserted_count=1, modified_count=2, matched_count=2)
+        )
+        headers = get_auth_headers(server, "admin", "admin")
+        with patch.object(server, "db", fake_db), patch.object(server, "price_matrix_cache", cache):
+            response = client.post(
+                "/api/price-matrix/upload", params={"dry_run": True},
+                files={"file": ("matrix.csv", csv_content.encode(), "text/csv")}, headers=headers,
+            )
+            assert response.status_code == 200
+            diff = response.json()
+            fake_db.price_matrix.bulk_write.assert_not_called()
+
+            assert [(c["category"], c["old_price"], c["new_price"]) for c in diff["changed"]] == [("Jeans", 20.0, 25.0)]
+            assert [(c["price_level"], c["old_price"], c["new_price"]) for c in diff["added"]] == [("Teuer", None, 15.0)]
+            assert [(c["category"], c["old_price"], c["new_price"]) for c in diff["removed"]] == [("Hosen", 10.0, None)]
+            assert (diff["unchanged"], diff["invalid"]) == (1, 1)
+
+            applied = client.post(f"/api/price-matrix/diffs/{diff['diff_id']}/apply", headers=headers)
+            again = client.post(f"/api/price-matrix/diffs/{diff['diff_id']}/apply", headers=headers)
+
+        assert applied.status_code == 200
+        assert len(fake_db.price_matrix.bulk_write.call_args.args[0]) == 3
+        assert again.status_code == 404
+
+    def test_stale_apply_does_not_bump_version(self, server, client):
+        import pandas as pd
+        cells = pd.DataFrame([{"category": "Jeans", "price_level": "Luxus", "condition": "Neu",
+                               "relevance": "Wichtig", "fixed_price": 25.0}])
+        pending = {"stale": {"version": 3, "cells": cells, "rejected": [], "created": time.time()}}
+        fake_db = make_db(version=4)
+        fake_db.price_matrix.bulk_write = AsyncMock()
+        headers = get_auth_headers(server, "admin", "admin")
+        with patch.object(server, "db", fake_db), patch.object(server, "pending_price_matrix_diffs", pending):
+            response = client.post("/api/price-matrix/diffs/stale/apply", headers=headers)
+
+        assert response.status_code == 409
+        fake_db.app_settings.find_one_and_update.assert_not_called()
+        fake_db.price_matrix.bulk_write.assert_not_called()
+
+
+class TestPricingRules:
+
+    RULES = {
+        "base_prices": {"Jeans": 20.0},
+        "price_levels": {"Luxus": {"multiplier": 2.0}, "Günstig": {"multiplier": 0.5}},
+        "conditions": {"Abgenutzt": {"multiplier": 0.5, "offset": -1.0}},
+        "relevance_levels": {"Nicht beliebt": {"offset": -2.0}},
+        "rounding": 0.5,
+    }
+
+    def test_materialized_grid(self, server):
+        grid = server.materialize_pricing_rules(self.RULES, ["Jeans", "Hosen"])
+        assert grid.shape == (2, 4, 4, 3)
+        assert grid[0, 0, 0, 0] == 40.0                    # 20 × 2
+        assert grid[0, 3, 3, 2] == 2.0                     # 20 × 0.5 × 0.5 − 1 − 2 = 2
+        assert grid[0, 2, 0, 1] == 20.0                    # no adjustments
+        assert np.isnan(grid[1]).all()                     # no base price for Hosen
+
+    def test_explicit_cells_override_rules(self, server):
+        cache = server.PriceMatrixCache(server.CATEGORIES, [
+            {"category": "Jeans", "price_level": "Luxus", "condition": "Neu", "relevance": "Stark relevant", "fixed_price": 35},
+        ], rules=self.RULES)
+        assert cache.lookup("Jeans", "Luxus", "Neu", "Stark relevant") == 35.0
+        assert cache.lookup("Jeans", "Teuer", "Neu", "Stark relevant") == 20.0
+        assert cache.lookup("Hosen", "Teuer", "Neu", "Stark relevant") is None
+        # Downloads and diffs only see the explicit cell
+        assert (~np.isnan(cache.fixed)).sum() == 1
+
+    def test_rules_reject_unknown_axis_values(self, server, client):
+        fake_db = make_db()
+        with patch.object(server, "db", fake_db):
+            response = client.put("/api/pricing-rules", json={"conditions": {"Wie neu": {"multiplier": 1.1}}},
+                                  headers=get_auth_headers(server, "admin", "admin"))
+        assert response.status_code == 400
+        fake_db.pricing_rules.replace_one.assert_not_called()
+
+    def test_rules_change_records_rules_version(self, server, client):
+        fake_db = make_db(version=4)
+        fake_db.pricing_rules.replace_one = AsyncMock()
+        with patch.object(server, "db", fake_db), patch.object(server, "price_matrix_cache", None):
+            response = client.put("/api/pricing-rules", json=self.RULES, headers=get_auth_headers(server, "admin", "admin"))
+
+        assert response.status_code == 200
+        fake_db.app_settings.update_one.assert_called_once_with(
+            {"type": "price_matrix"}, {"$set": {"rules_version": 5}}
+        )
+
+
+
+class TestPriceSuggestions:
+
+    CELL = {"category": "Jeans", "price_level": "Mittel", "condition": "Neu", "relevance": "Wichtig"}
+
+    def test_lookup_returns_suggestion_without_fixed_price(self, server, client):
+        cache = server.PriceMatrixCache(server.CATEGORIES, [])
+        suggestion = {"median": 12.0, "p25": 10.0, "p75": 15.0, "count": 8}
+        index = {tuple(self.CELL.values()): suggestion}
+        with patch.object(server, "price_matrix_cache", cache), patch.object(server, "price_suggestion_index", index):
+            response = client.get("/api/price-matrix/lookup", params=self.CELL,
+                                  headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+        assert response.json() == {"fixed_price": None, "found": False, "suggestion": suggestion}
+
+    def test_incremental_refresh_only_touches_given_cells(self, server):
+        import asyncio
+        other = {**self.CELL, "condition": "Abgenutzt"}
+        aggregated = {"_id": dict(self.CELL), **self.CELL, "count": 3, "median": 11.0, "p25": 9.0, "p75": 14.0}
+        fake_db = MagicMock()
+        fake_db.purchases.aggregate = MagicMock(return_value=make_cursor([aggregated]))
+        fake_db.price_suggestions.bulk_write = AsyncMock()
+        index = {tuple(other.values()): {"median": 1.0, "p25": 1.0, "p75": 1.0, "count": 1}}
+
+        with patch.object(server, "db", fake_db), patch.object(server, "price_suggestion_index", index):
+            asyncio.run(server.refresh_price_suggestions([self.CELL, other, self.CELL]))
+            assert index[tuple(self.CELL.values())]["median"] == 11.0
+            assert tuple(other.values()) not in index
+
+        pipeline = fake_db.purchases.aggregate.call_args.args[0]
+        assert len(pipeline[0]["$match"]["items"]["$elemMatch"]["$or"]) == 2
+        # Legacy items without relevance belong to "Wichtig", as in the full rebuild
+        assert all(f["items.relevance"] == {"$in": ["Wichtig", None]} for f in pipeline[2]["$match"]["$or"])
+        assert server.price_suggestion_cell_filter({**self.CELL, "relevance": "Stark relevant"})["relevance"] == "Stark relevant"
+        operations = fake_db.price_suggestions.bulk_write.call_args.args[0]
+        assert [type(op).__name__ for op in operations].count("DeleteOne") == 1
+
+    def test_startup_builds_empty_suggestions_from_history(self, server):
+        import asyncio
+        fake_db = MagicMock()
+        fake_db.price_suggestions.find = MagicMock(return_value=make_cursor([]))
+        fake_db.purchases.find_one = AsyncMock(return_value={"_id": 1})
+        with patch.object(server, "db", fake_db), \
+                patch.object(server, "rebuild_price_suggestions", AsyncMock(return_value=12)) as rebuild:
+            asyncio.run(server.load_price_suggestion_index())
+        rebuild.assert_awaited_once()
+        assert server.CLI_COMMANDS["rebuild-price-suggestions"] is server.rebuild_price_suggestions
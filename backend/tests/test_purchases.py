@@ -0,0 +1,144 @@
+import pytest
+from unittest.mock import MagicMock, AsyncMock, patch
+from conftest import get_auth_headers, make_cursor, FakeSession, make_mongo_client
+
+
+ITEMS = [{"category": "Jeans", "price_level": "Mittel", "condition": "Neu", "relevance": "Wichtig", "price": 12.5}]
+
+
+class TestPurchaseHistory:
+
+    def test_purchase_history_pages_summaries(self, server, client):
+        fake_db = MagicMock()
+        stamp = server.datetime(2024, 5, 1, 9, 0)
+        docs = [{"id": f"p{i}", "total": 10.0, "timestamp": stamp, "item_count": 2} for i in range(3)]
+        cursor = make_cursor(docs)
+        fake_db.purchases.find = MagicMock(return_value=cursor)
+        fake_db.stats_rollups.aggregate = MagicMock(return_value=make_cursor([{"_id": None, "count": 1234}]))
+        with patch.object(server, "db", fake_db):
+            response = client.get("/api/purchases", params={"limit": 2},
+                                  headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+
+        assert response.status_code == 200
+        body = response.json()
+        assert [p["id"] for p in body["purchases"]] == ["p0", "p1"]
+        assert body["purchases"][0]["items"] is None
+        assert server.decode_cursor(body["next_cursor"]) == (stamp, "p1")
+        projection = fake_db.purchases.find.call_args[0][1]
+        assert "items" not in projection and projection["item_count"] == {"$size": "$items"}
+        cursor.sort.assert_called_with([("timestamp", -1), ("id", -1)])
+        # The total comes from the monthly rollups, not from counting purchases
+        assert body["total_count"] == 1234
+        fake_db.purchases.count_documents.assert_not_called()
+
+
+class TestReceiptNumbers:
+
+    def test_number_formats(self, server):
+        assert server.receipt_number_query("Nr. 1a2b3c4d") == {"short_id": "1A2B3C4D"}
+        assert server.receipt_number_query("#1A2B3C4D") == {"short_id": "1A2B3C4D"}
+        full = "1A2B3C4D-0000-4000-8000-000000000000"
+        assert server.receipt_number_query(full) == {"id": full.lower()}
+        with pytest.raises(server.HTTPException):
+            server.receipt_number_query("12345")
+
+    def test_lookup_reports_ambiguous_numbers(self, server, client):
+        fake_db = MagicMock()
+        fake_db.purchases.find = MagicMock(return_value=make_cursor([{"id": "a"}, {"id": "b"}]))
+        with patch.object(server, "db", fake_db):
+            response = client.get("/api/purchases/by-number/1A2B3C4D",
+                                  headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+        assert response.status_code == 409
+        assert fake_db.purchases.find.call_args[0][0] == {"short_id": "1A2B3C4D", "deleted": {"$ne": True}}
+
+    def test_receipt_number_clash_retries_with_new_id(self, server, client):
+        fake_db = MagicMock()
+        clash = server.DuplicateKeyError("E11000", details={"keyPattern": {"short_id": -1}})
+        # The first drawn id clashes with an existing receipt number
+        fake_db.purchases.insert_one = AsyncMock(side_effect=[clash, None])
+        fake_db.stats_rollups.bulk_write = AsyncMock()
+        fake_db.idempotency_keys.insert_one = AsyncMock()
+        fake_db.idempotency_keys.update_one = AsyncMock()
+        with patch.object(server, "db", fake_db), patch.object(server, "client", make_mongo_client(FakeSession())), \
+                patch.object(server, "schedule_price_suggestion_refresh"):
+            response = client.post("/api/purchases", json={"items": ITEMS}, headers={
+                **get_auth_headers(server, "smilla", "mitarbeiter"), "Idempotency-Key": "k-1"
+            })
+
+        assert response.status_code == 200
+        first, second = [c[0][0] for c in fake_db.purchases.insert_one.call_args_list]
+        assert second["short_id"] == second["id"][:8].upper() == response.json()["id"][:8].upper()
+        assert second["short_id_unique"] and second["short_id"] != first["short_id"]
+        # No lookup before the insert: the unique index does the checking
+        fake_db.purchases.find_one.assert_not_called()
+        fake_db.idempotency_keys.update_one.assert_awaited_once_with(
+            {"key": "k-1", "purchase_id": first["id"]}, {"$set": {"purchase_id": second["id"]}}
+        )
+
+    def test_other_duplicate_key_errors_are_not_retried(self, server, client):
+        fake_db = MagicMock()
+        fake_db.purchases.insert_one = AsyncMock(side_effect=server.DuplicateKeyError("E11000", details={"keyPattern": {"id": 1}}))
+        with patch.object(server, "db", fake_db), patch.object(server, "client", make_mongo_client(FakeSession())), \
+                pytest.raises(server.DuplicateKeyError):
+            client.post("/api/purchases", json={"items": ITEMS}, headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+        assert fake_db.purchases.insert_one.await_count == 1
+
+class TestIdempotentPurchases:
+
+    def make_db(self):
+        fake_db = MagicMock()
+        fake_db.purchases.find_one = AsyncMock(return_value=None)
+        fake_db.purchases.insert_one = AsyncMock()
+        fake_db.idempotency_keys.insert_one = AsyncMock()
+        fake_db.idempotency_keys.delete_one = AsyncMock()
+        fake_db.stats_rollups.bulk_write = AsyncMock()
+        return fake_db
+
+    def post(self, server, client, fake_db, payload):
+        with patch.object(server, "db", fake_db), patch.object(server, "client", make_mongo_client(FakeSession())), \
+                patch.object(server, "schedule_price_suggestion_refresh"):
+            return client.post("/api/purchases", json=payload, headers={
+                **get_auth_headers(server, "smilla", "mitarbeiter"), "Idempotency-Key": "k-1"
+            })
+
+    def test_first_request_claims_key(self, server, client):
+        fake_db = self.make_db()
+        response = self.post(server, client, fake_db, {"items": ITEMS})
+
+        assert response.status_code == 200
+        claim = fake_db.idempotency_keys.insert_one.call_args[0][0]
+        assert claim["key"] == "k-1" and claim["purchase_id"] == response.json()["id"]
+        fake_db.purchases.insert_one.assert_called_once()
+
+    def test_retry_returns_original_purchase(self, server, client):
+        fake_db = self.make_db()
+        original = {"id": "p-1", "items": ITEMS, "total": 12.5, "staff_username": "smilla",
+                    "timestamp": server.datetime(2024, 5, 1, 9, 0)}
+        fake_db.idempotency_keys.insert_one = AsyncMock(side_effect=server.DuplicateKeyError("E11000"))
+        fake_db.idempotency_keys.find_one = AsyncMock(return_value={"key": "k-1", "purchase_id": "p-1"})
+        fake_db.purchases.find_one = AsyncMock(return_value=original)
+        response = self.post(server, client, fake_db, {"items": ITEMS})
+
+        assert response.status_code == 200
+        assert response.json()["id"] == "p-1"
+        assert response.json()["timestamp"] == "2024-05-01T09:00:00"
+        fake_db.purchases.insert_one.assert_not_called()
+
+    def test_concurrent_retry_is_rejected(self, server, client):
+        fake_db = self.make_db()
+        fake_db.idempotency_keys.insert_one = AsyncMock(side_effect=server.DuplicateKeyError("E11000"))
+        fake_db.idempotency_keys.find_one = AsyncMock(return_value={"key": "k-1", "purchase_id": "p-1"})
+        fake_db.idempotency_keys.find_one_and_update = AsyncMock(return_value=None)
+        response = self.post(server, client, fake_db, {"items": ITEMS})
+
+        assert response.status_code == 409
+        fake_db.purchases.insert_one.assert_not_called()
+
+    def test_failed_purchase_releases_key(self, server, client):
+        fake_db = self.make_db()
+        fake_db.customers.find_one_and_update = AsyncMock(return_value=None)
+        response = self.post(server, client, fake_db, {"items": ITEMS, "credit_customer_id": "missing"})
+
+        assert response.status_code == 404
+        released = fake_db.idempotency_keys.delete_one.call_args[0][0]
+        assert released["key"] == "k-1"
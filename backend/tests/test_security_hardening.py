@@ -26,6 +26,7 @@ mock_collection.find_one = AsyncMock(return_value=None)
 mock_collection.insert_one = AsyncMock(return_value=MagicMock(inserted_id="123"))
 mock_collection.update_one = AsyncMock(return_value=MagicMock(matched_count=1, modified_count=1))
 mock_collection.delete_one = AsyncMock(return_value=MagicMock(deleted_count=1))
+mock_collection.bulk_write = AsyncMock(return_value=MagicMock(modified_count=1))
 # find() returns a cursor which needs to be async iterable or have to_list awaitable
 mock_cursor = MagicMock()
 mock_cursor.to_list = AsyncMock(return_value=[])
@@ -44,6 +45,13 @@ mock_db.credit_transactions = mock_collection
 mock_db.app_settings = mock_collection
 mock_db.custom_categories = mock_collection
 mock_db.price_matrix = mock_collection
+mock_db.stats_rollups = mock_collection
+
+# Purchases are written in a transaction: client.start_session() -> session context
+mock_session = MagicMock()
+mock_session.__aenter__.return_value = mock_session
+mock_session.start_transaction = MagicMock(return_value=mock_session)
+mock_client.start_session = AsyncMock(return_value=mock_session)
 
 # In case server.py used db['collection'], but it seems it uses dot notation for collections
 mock_db.__getitem__ = MagicMock(return_value=mock_collection)
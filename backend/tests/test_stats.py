@@ -0,0 +1,159 @@
+import asyncio
+from unittest.mock import MagicMock, AsyncMock, patch
+from conftest import get_auth_headers, make_cursor, FakeSession
+
+
+class TestDailyStats:
+
+    def test_daily_stats_read_day_rollups(self, server, client):
+        fake_db = MagicMock()
+        cursor = make_cursor([{"key": "2024-05-02", "count": 3, "total": 45.0}])
+        fake_db.stats_rollups.find = MagicMock(return_value=cursor)
+        with patch.object(server, "db", fake_db):
+            response = client.get("/api/stats/daily", params={"days": 7},
+                                  headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+
+        assert response.status_code == 200
+        assert response.json() == [{"date": "2024-05-02", "count": 3, "total": 45.0}]
+        query = fake_db.stats_rollups.find.call_args[0][0]
+        assert query["period"] == "day"
+        assert query["key"] == {"$gte": server.shop_day_start(6).strftime("%Y-%m-%d")}
+        fake_db.purchases.aggregate.assert_not_called()
+
+    def test_shop_day_start_counts_back_calendar_days(self, server):
+        assert (server.shop_day_start(0).date() - server.shop_day_start(6).date()).days == 6
+        assert server.shop_day_start(0) <= server.datetime.now(server.timezone.utc)
+
+
+class TestStatsRollups:
+
+    def test_updates_use_shop_calendar(self, server):
+        purchase = {"timestamp": server.datetime(2024, 5, 31, 22, 30), "total": 20.0, "items": [{}, {}]}
+        day, month = server.stats_rollup_updates(purchase, sign=-1)
+        assert day._filter == {"_id": "day:2024-06-01"}
+        assert month._filter == {"_id": "month:2024-06"}
+        assert month._doc["$inc"] == {"count": -1, "total": -20.0, "item_count": -2}
+        assert month._doc["$setOnInsert"] == {"period": "month", "key": "2024-06"}
+        assert month._upsert
+
+    def test_monthly_stats_read_rollups(self, server, client):
+        fake_db = MagicMock()
+        cursor = make_cursor([{"key": "2024-06", "count": 4, "total": 80.0}])
+        fake_db.stats_rollups.find = MagicMock(return_value=cursor)
+        with patch.object(server, "db", fake_db):
+            response = client.get("/api/stats/monthly", params={"months": 3},
+                                  headers=get_auth_headers(server, "smilla", "mitarbeiter"))
+
+        assert response.status_code == 200
+        assert response.json() == [{"month": "2024-06", "count": 4, "total": 80.0}]
+        assert fake_db.stats_rollups.find.call_args[0][0]["period"] == "month"
+        cursor.limit.assert_called_once_with(3)
+        fake_db.purchases.find.assert_not_called()
+
+    def test_soft_delete_reverses_rollups_in_transaction(self, server, client):
+        fake_db = MagicMock()
+        purchase = {"items": [{}], "total": 5.0, "timestamp": server.datetime(2024, 5, 1, 9, 0)}
+        fake_db.purchases.find_one_and_update = AsyncMock(return_value=purchase)
+        fake_db.stats_rollups.bulk_write = AsyncMock()
+        session = FakeSession()
+        mongo_client = MagicMock()
+        mongo_client.start_session = AsyncMock(return_value=session)
+        with patch.object(server, "db", fake_db), patch.object(server, "client", mongo_client), \
+                patch.object(server, "schedule_price_suggestion_refresh"):
+            response = client.delete("/api/purchases/p1", headers=get_auth_headers(server, "admin", "admin"))
+
+        assert response.status_code == 200
+        operations = fake_db.stats_rollups.bulk_write.call_args[0][0]
+        assert [op._doc["$inc"]["count"] for op in operations] == [-1, -1]
+        assert fake_db.stats_rollups.bulk_write.call_args.kwargs["session"] is session
+
+    def test_rebuild_waits_for_purchase_writes(self, server):
+        fake_db = MagicMock()
+        fake_db.purchases.aggregate = MagicMock(return_value=make_cursor([]))
+        fake_db.stats_rollups.count_documents = AsyncMock(return_value=0)
+        order = []
+
+        async def scenario():
+            async def writer():
+                async with server.stats_rollups_lock.shared():
+                    order.append("write started")
+                    await asyncio.sleep(0.01)
+                    order.append("write done")
+
+            async def rebuild():
+                await asyncio.sleep(0)
+                await server.rebuild_stats_rollups()
+                order.append("rebuilt")
+
+            await asyncio.gather(writer(), rebuild())
+
+        with patch.object(server, "db", fake_db), patch.object(server, "stats_rollups_lock", server.SharedExclusiveLock()):
+            asyncio.run(scenario())
+
+        assert order == ["write started", "write done", "rebuilt"]
+
+    def test_purchase_writes_share_the_lock(self, server):
+        lock = server.SharedExclusiveLock()
+        order = []
+
+        async def writer(name):
+            async with lock.shared():
+                order.append(f"{name} started")
+                await asyncio.sleep(0.01)
+                order.append(f"{name} done")
+
+        async def rebuild():
+            await asyncio.sleep(0)
+            async with lock.exclusive():
+                order.append("rebuilt")
+
+        async def late_writer():
+            await asyncio.sleep(0.005)
+            await writer("c")
+
+        async def scenario():
+            await asyncio.gather(writer("a"), writer("b"), rebuild(), late_writer())
+
+        asyncio.run(scenario())
+
+        # a and b overlap; the waiting rebuild keeps c out until it is done
+        assert order[:2] == ["a started", "b started"]
+        assert order[2:] == ["a done", "b done", "rebuilt", "c started", "c done"]
+
+
+class TestTodayTally:
+
+    def make_tally(self, server, fake_db, totals):
+        fake_db.purchases.aggregate = MagicMock(return_value=make_cursor(totals))
+        return server.TodayTally()
+
+    def test_seeded_once_then_served_from_memory(self, server, client):
+        fake_db = MagicMock()
+        tally = self.make_tally(server, fake_db, [{"count": 2, "total": 30.0, "items": 5}])
+        headers = get_auth_headers(server, "smilla", "mitarbeiter")
+        with patch.object(server, "db", fake_db), patch.object(server, "today_tally", tally):
+            first = client.get("/api/stats/today", headers=headers)
+            second = client.get("/api/stats/today", headers=headers)
+
+        assert first.json() == second.json()
+        assert first.json()["total_purchases"] == 2 and first.json()["total_items"] == 5
+        assert fake_db.purchases.aggregate.call_count == 1
+
+    def test_create_and_delete_move_tally_and_notify(self, server):
+        fake_db = MagicMock()
+        tally = self.make_tally(server, fake_db, [])
+
+        async def scenario():
+            await tally.seed()
+            queue = tally.subscribe()
+            now = server.datetime.now(server.timezone.utc)
+            tally.apply({"timestamp": now, "total": 12.5, "items": [{}, {}]})
+            tally.apply({"timestamp": now - server.timedelta(days=3), "total": 99.0, "items": [{}]}, sign=-1)
+            return queue.get_nowait(), queue.qsize()
+
+        with patch.object(server, "db", fake_db):
+            snapshot, pending = asyncio.run(scenario())
+
+        assert snapshot["total_purchases"] == 1 and snapshot["total_amount"] == 12.5 and snapshot["total_items"] == 2
+        # Deleting an older purchase does not touch today's tally
+        assert pending == 0
@@ -33,6 +33,37 @@ apiClient.interceptors.response.use(
   }
 );
 
+// crypto.randomUUID() needs a secure context (and Safari 15.4+), so plain-HTTP
+// LAN setups and older iPads fall back to a v4 UUID from getRandomValues()
+const newIdempotencyKey = () => {
+  if (typeof crypto.randomUUID === 'function' && window.isSecureContext) {
+    return crypto.randomUUID();
+  }
+  const bytes = crypto.getRandomValues(new Uint8Array(16));
+  bytes[6] = (bytes[6] & 0x0f) | 0x40; // version 4
+  bytes[8] = (bytes[8] & 0x3f) | 0x80; // RFC 4122 variant
+  const hex = Array.from(bytes, (b) => b.toString(16).padStart(2, '0')).join('');
+  return `${hex.slice(0, 8)}-${hex.slice(8, 12)}-${hex.slice(12, 16)}-${hex.slice(16, 20)}-${hex.slice(20)}`;
+};
+
+// Submit a purchase, retrying timeouts and network errors with the same
+// Idempotency-Key so the server creates it at most once
+const PURCHASE_ATTEMPTS = 3;
+const postPurchase = async (body) => {
+  const headers = { 'Idempotency-Key': newIdempotencyKey() };
+  for (let attempt = 1; ; attempt++) {
+    try {
+      const response = await apiClient.post('/purchases', body, { headers, timeout: 10000 });
+      return response.data;
+    } catch (error) {
+      // 409: an earlier attempt is still being processed
+      const retryable = !error.response || error.response.status === 409;
+      if (!retryable || attempt >= PURCHASE_ATTEMPTS) throw error;
+      await new Promise((resolve) => setTimeout(resolve, 500 * attempt));
+    }
+  }
+};
+
 // API functions
 export const api = {
   // Get categories config
@@ -42,16 +73,15 @@ export const api = {
   },
 
   // Create a new purchase
-  createPurchase: async (items) => {
-    const response = await apiClient.post('/purchases', { items });
-    return response.data;
-  },
+  createPurchase: async (items) => postPurchase({ items }),
 
   // Get all purchases with optional date filter
-  getPurchases: async (startDate = null, endDate = null) => {
+  // One page of purchase summaries; pass the previous page's next_cursor to continue
+  getPurchases: async (startDate = null, endDate = null, cursor = null) => {
     const params = {};
     if (startDate) params.start_date = startDate;
     if (endDate) params.end_date = endDate;
+    if (cursor) params.cursor = cursor;
     const response = await apiClient.get('/purchases', { params });
     return response.data;
   },
@@ -62,6 +92,12 @@ export const api = {
     return response.data;
   },
 
+  // Look up a purchase by receipt number ("Nr. 1A2B3C4D") or scanned full id
+  getPurchaseByNumber: async (number) => {
+    const response = await apiClient.get(`/purchases/by-number/${encodeURIComponent(number)}`);
+    return response.data;
+  },
+
   // Delete purchase
   deletePurchase: async (id) => {
     const response = await apiClient.delete(`/purchases/${id}`);
@@ -92,6 +128,41 @@ export const api = {
     return response.data;
   },
 
+  // Live today counter via Server-Sent Events; returns a function that stops it.
+  // Uses fetch rather than EventSource so the JWT can go in the Authorization header.
+  subscribeTodayStats: (onUpdate) => {
+    const controller = new AbortController();
+    const listen = async () => {
+      while (!controller.signal.aborted) {
+        try {
+          const response = await fetch(`${API}/stats/today/stream`, {
+            headers: { Authorization: `Bearer ${localStorage.getItem('rewear_token')}` },
+            signal: controller.signal,
+          });
+          if (response.status === 401) return;
+          const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+          let buffer = '';
+          for (;;) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += value;
+            const events = buffer.split('\n\n');
+            buffer = events.pop();
+            for (const event of events) {
+              if (event.startsWith('data: ')) onUpdate(JSON.parse(event.slice(6)));
+            }
+          }
+        } catch (error) {
+          if (controller.signal.aborted) return;
+        }
+        // Connection dropped: reconnect after a pause
+        await new Promise((resolve) => setTimeout(resolve, 5000));
+      }
+    };
+    listen();
+    return () => controller.abort();
+  },
+
   // Price Matrix APIs
   lookupFixedPrice: async (category, priceLevel, condition, relevance) => {
     const response = await apiClient.get('/price-matrix/lookup', {
@@ -105,8 +176,22 @@ export const api = {
     return response.data;
   },
 
-  getPriceMatrix: async () => {
-    const response = await apiClient.get('/price-matrix');
+  // Resolve several cells at once: keys = [{ category, price_level, condition, relevance }]
+  lookupFixedPrices: async (keys) => {
+    const response = await apiClient.post('/price-matrix/lookup/batch', { items: keys });
+    return response.data.results;
+  },
+
+  // With `since` (the version of a local copy) only changes since then are returned
+  getPriceMatrix: async (since = null) => {
+    const params = since !== null ? { since } : {};
+    const response = await apiClient.get('/price-matrix', { params });
+    return response.data;
+  },
+
+  // Whole grid as { version, axes, prices }: prices is flat in axis order, null = no fixed price
+  getPriceMatrixCompact: async () => {
+    const response = await apiClient.get('/price-matrix', { params: { format: 'compact' } });
     return response.data;
   },
 
@@ -134,11 +219,50 @@ export const api = {
     return response.data;
   },
 
+  // Dry run: returns added/changed/removed cells and a diff_id for applyPriceMatrixDiff
+  previewPriceMatrixUpload: async (file) => {
+    const formData = new FormData();
+    formData.append('file', file);
+    const response = await apiClient.post('/price-matrix/upload', formData, {
+      headers: { 'Content-Type': 'multipart/form-data' },
+      params: { dry_run: true }
+    });
+    return response.data;
+  },
+
+  applyPriceMatrixDiff: async (diffId) => {
+    const response = await apiClient.post(`/price-matrix/diffs/${diffId}/apply`);
+    return response.data;
+  },
+
   clearPriceMatrix: async () => {
     const response = await apiClient.delete('/price-matrix');
     return response.data;
   },
 
+  // Recompute per-day and per-month statistics from all purchases
+  rebuildStatsRollups: async () => {
+    const response = await apiClient.post('/stats/rollups/rebuild');
+    return response.data;
+  },
+
+  // Recompute historical price suggestions from all purchases
+  rebuildPriceSuggestions: async () => {
+    const response = await apiClient.post('/price-suggestions/rebuild');
+    return response.data;
+  },
+
+  // Pricing rules (base price per category + adjustments per level/condition/relevance)
+  getPricingRules: async () => {
+    const response = await apiClient.get('/pricing-rules');
+    return response.data;
+  },
+
+  updatePricingRules: async (rules) => {
+    const response = await apiClient.put('/pricing-rules', rules);
+    return response.data;
+  },
+
   // Auth
   login: async (username, password) => {
     const response = await apiClient.post('/auth/login', { username, password });
@@ -222,6 +346,18 @@ export const api = {
   getCustomers: async (search = '') => {
     const params = search ? { search } : {};
     const response = await apiClient.get('/customers', { params });
+    return response.data.customers;
+  },
+
+  // One page of customers; pass the previous page's next_cursor to continue
+  getCustomersPage: async (search = '', cursor = null) => {
+    const params = { ...(search ? { search } : {}), ...(cursor ? { cursor } : {}) };
+    const response = await apiClient.get('/customers', { params });
+    return response.data;
+  },
+
+  searchCustomers: async (q, limit = 10) => {
+    const response = await apiClient.get('/customers/typeahead', { params: { q, limit } });
     return response.data;
   },
 
@@ -231,12 +367,17 @@ export const api = {
     return response.data;
   },
 
-  // Get single customer with transactions
+  // Get single customer with one page of transactions (newest first)
   getCustomer: async (id) => {
     const response = await apiClient.get(`/customers/${id}`);
     return response.data;
   },
 
+  getCustomerTransactions: async (id, cursor) => {
+    const response = await apiClient.get(`/customers/${id}/transactions`, { params: { cursor } });
+    return response.data;
+  },
+
   // Update customer
   updateCustomer: async (id, customerData) => {
     const response = await apiClient.put(`/customers/${id}`, customerData);
@@ -258,6 +399,12 @@ export const api = {
     return response.data;
   },
 
+  // Recompute all balances from the ledger; dryRun only reports drift
+  reconcileBalances: async (dryRun = false) => {
+    const response = await apiClient.post('/customers/reconcile', null, { params: { dry_run: dryRun } });
+    return response.data;
+  },
+
   // Export customers to Excel
   exportCustomersExcel: async () => {
     const response = await apiClient.get('/customers/export/excel', {
@@ -273,14 +420,11 @@ export const api = {
     window.URL.revokeObjectURL(url);
   },
 
-  createPurchaseWithCredit: async (items, creditCustomerId = null, staffUsername = null) => {
-    const response = await apiClient.post('/purchases', {
-      items,
-      credit_customer_id: creditCustomerId,
-      staff_username: staffUsername
-    });
-    return response.data;
-  },
+  createPurchaseWithCredit: async (items, creditCustomerId = null, staffUsername = null) => postPurchase({
+    items,
+    credit_customer_id: creditCustomerId,
+    staff_username: staffUsername
+  }),
 
   // ============== Digitization APIs (Gemini) ==============
 
@@ -25,6 +25,7 @@ export default function CustomerDetailPage() {
     const [transactionDescription, setTransactionDescription] = useState('');
     const [editData, setEditData] = useState({});
     const [saving, setSaving] = useState(false);
+    const [loadingMore, setLoadingMore] = useState(false);
 
     useEffect(() => {
         loadCustomer();
@@ -51,6 +52,23 @@ export default function CustomerDetailPage() {
         }
     };
 
+    const loadMoreTransactions = async () => {
+        try {
+            setLoadingMore(true);
+            const data = await api.getCustomerTransactions(id, customer.next_cursor);
+            setCustomer((prev) => ({
+                ...prev,
+                ...data,
+                transactions: [...prev.transactions, ...data.transactions]
+            }));
+        } catch (error) {
+            console.error('Error loading transactions:', error);
+            toast.error('Fehler beim Laden');
+        } finally {
+            setLoadingMore(false);
+        }
+    };
+
     const handleCreateTransaction = async () => {
         const amount = parseFloat(transactionAmount);
         if (isNaN(amount) || amount <= 0) {
@@ -240,7 +258,7 @@ export default function CustomerDetailPage() {
                     <CardHeader className="flex flex-row items-center justify-between">
                         <CardTitle className="text-lg">Transaktionshistorie</CardTitle>
                         <span className="text-sm text-muted-foreground">
-                            {customer.transactions?.length || 0} Transaktionen
+                            {customer.transaction_count ?? customer.transactions?.length ?? 0} Transaktionen
                         </span>
                     </CardHeader>
                     <CardContent>
@@ -277,6 +295,13 @@ export default function CustomerDetailPage() {
                                         </span>
                                     </div>
                                 ))}
+                                {customer.has_more && (
+                                    <div className="pt-4 text-center">
+                                        <Button variant="outline" onClick={loadMoreTransactions} disabled={loadingMore}>
+                                            {loadingMore ? 'Lädt...' : 'Ältere Transaktionen laden'}
+                                        </Button>
+                                    </div>
+                                )}
                             </div>
                         )}
                     </CardContent>
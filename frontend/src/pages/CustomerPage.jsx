@@ -14,7 +14,9 @@ export default function CustomerPage() {
     const navigate = useNavigate();
     const { user } = useAuth();
     const [customers, setCustomers] = useState([]);
+    const [nextCursor, setNextCursor] = useState(null);
     const [loading, setLoading] = useState(true);
+    const [loadingMore, setLoadingMore] = useState(false);
     const [searchTerm, setSearchTerm] = useState('');
     const [showAddDialog, setShowAddDialog] = useState(false);
     const [newCustomer, setNewCustomer] = useState({
@@ -42,8 +44,9 @@ export default function CustomerPage() {
     const loadCustomers = async (search = '') => {
         try {
             setLoading(true);
-            const data = await api.getCustomers(search);
-            setCustomers(data);
+            const data = await api.getCustomersPage(search);
+            setCustomers(data.customers);
+            setNextCursor(data.next_cursor);
         } catch (error) {
             console.error('Error loading customers:', error);
             toast.error('Fehler beim Laden der Kunden');
@@ -52,6 +55,20 @@ export default function CustomerPage() {
         }
     };
 
+    const loadMoreCustomers = async () => {
+        try {
+            setLoadingMore(true);
+            const data = await api.getCustomersPage(searchTerm, nextCursor);
+            setCustomers((prev) => [...prev, ...data.customers]);
+            setNextCursor(data.next_cursor);
+        } catch (error) {
+            console.error('Error loading customers:', error);
+            toast.error('Fehler beim Laden der Kunden');
+        } finally {
+            setLoadingMore(false);
+        }
+    };
+
     const handleAddCustomer = async () => {
         if (!newCustomer.first_name.trim() || !newCustomer.last_name.trim()) {
             toast.error('Vorname und Nachname sind erforderlich');
@@ -209,6 +226,13 @@ export default function CustomerPage() {
                                 </CardContent>
                             </Card>
                         ))}
+                        {nextCursor && (
+                            <div className="pt-4 text-center">
+                                <Button variant="outline" onClick={loadMoreCustomers} disabled={loadingMore}>
+                                    {loadingMore ? 'Lädt...' : 'Weitere Kunden laden'}
+                                </Button>
+                            </div>
+                        )}
                     </div>
                 )}
             </main>
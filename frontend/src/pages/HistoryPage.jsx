@@ -17,6 +17,10 @@ import api from '@/lib/api';
 
 export default function HistoryPage() {
   const [purchases, setPurchases] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [totalCount, setTotalCount] = useState(0);
+  const [loadingMore, setLoadingMore] = useState(false);
+  const [purchaseItems, setPurchaseItems] = useState({});
   const [dailyStats, setDailyStats] = useState([]);
   const [monthlyStats, setMonthlyStats] = useState([]);
   const [todayStats, setTodayStats] = useState({});
@@ -41,7 +45,9 @@ export default function HistoryPage() {
         api.getMonthlyStats(12),
         api.getTodayStats(),
       ]);
-      setPurchases(purchasesData);
+      setPurchases(purchasesData.purchases);
+      setNextCursor(purchasesData.next_cursor);
+      setTotalCount(purchasesData.total_count);
       setDailyStats(dailyData);
       setMonthlyStats(monthlyData);
       setTodayStats(todayData);
@@ -53,6 +59,32 @@ export default function HistoryPage() {
     }
   };
 
+  const loadMorePurchases = async () => {
+    try {
+      setLoadingMore(true);
+      const data = await api.getPurchases(null, null, nextCursor);
+      setPurchases((prev) => [...prev, ...data.purchases]);
+      setNextCursor(data.next_cursor);
+    } catch (error) {
+      toast.error('Fehler beim Laden der Daten');
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
+  // The list only carries summaries; items are fetched when a purchase is opened
+  const togglePurchase = async (id, open) => {
+    setExpandedPurchase(open ? id : null);
+    if (open && !purchaseItems[id]) {
+      try {
+        const purchase = await api.getPurchase(id);
+        setPurchaseItems((prev) => ({ ...prev, [id]: purchase.items }));
+      } catch (error) {
+        toast.error('Fehler beim Laden der Daten');
+      }
+    }
+  };
+
   const handleDeletePurchase = async (id) => {
     try {
       await api.deletePurchase(id);
@@ -294,7 +326,7 @@ export default function HistoryPage() {
               <div className="min-w-0">
                 <p className="text-xs sm:text-sm text-muted-foreground">Gesamt</p>
                 <p className="font-display text-lg sm:text-2xl font-bold" data-testid="stat-total">
-                  {purchases.length}
+                  {totalCount}
                 </p>
               </div>
             </div>
@@ -329,7 +361,7 @@ export default function HistoryPage() {
                         <Collapsible
                           key={purchase.id}
                           open={expandedPurchase === purchase.id}
-                          onOpenChange={(open) => setExpandedPurchase(open ? purchase.id : null)}
+                          onOpenChange={(open) => togglePurchase(purchase.id, open)}
                         >
                           <div className="border rounded-lg overflow-hidden">
                             <CollapsibleTrigger className="w-full">
@@ -338,7 +370,7 @@ export default function HistoryPage() {
                                   <div className="text-left">
                                     <p className="font-medium">{formatDate(purchase.timestamp)}</p>
                                     <p className="text-sm text-muted-foreground">
-                                      {formatTime(purchase.timestamp)} • {purchase.items.length} Artikel
+                                      {formatTime(purchase.timestamp)} • {purchase.item_count} Artikel
                                     </p>
                                   </div>
                                 </div>
@@ -353,7 +385,7 @@ export default function HistoryPage() {
                             <CollapsibleContent>
                               <div className="border-t px-4 py-3 bg-muted/30">
                                 <div className="space-y-2 mb-4">
-                                  {purchase.items.map((item, idx) => (
+                                  {(purchaseItems[purchase.id] || []).map((item, idx) => (
                                     <div key={idx} className="flex justify-between text-sm">
                                       <span>
                                         {item.category} ({item.price_level}, {item.condition}, {item.relevance})
@@ -399,6 +431,13 @@ export default function HistoryPage() {
                           </div>
                         </Collapsible>
                       ))}
+                      {nextCursor && (
+                        <div className="pt-2 text-center">
+                          <Button variant="outline" onClick={loadMorePurchases} disabled={loadingMore}>
+                            {loadingMore ? 'Lädt...' : 'Ältere Ankäufe laden'}
+                          </Button>
+                        </div>
+                      )}
                     </div>
                   </ScrollArea>
                 )}
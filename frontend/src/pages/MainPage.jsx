@@ -1,4 +1,4 @@
-import { useState, useEffect, useMemo } from 'react';
+import { useState, useEffect, useMemo, useRef } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
 import {
   Shirt, Layers, Ruler, Briefcase, Scissors,
@@ -120,6 +120,7 @@ export default function MainPage() {
   const [selectedCustomer, setSelectedCustomer] = useState(null);
   const [customerSearch, setCustomerSearch] = useState('');
   const [customerResults, setCustomerResults] = useState([]);
+  const latestCustomerSearch = useRef('');
   const [isSearchingCustomers, setIsSearchingCustomers] = useState(false);
   const [categoryIcons, setCategoryIcons] = useState({});
   const [hiddenCategories, setHiddenCategories] = useState([]);
@@ -136,6 +137,9 @@ export default function MainPage() {
     ]);
   }, []);
 
+  // Keep the header counter live; sales on other tablets show up immediately
+  useEffect(() => api.subscribeTodayStats(setTodayStats), []);
+
   const loadTodayStats = async () => {
     try {
       const stats = await api.getTodayStats();
@@ -333,9 +337,10 @@ export default function MainPage() {
 
   const cartTotal = cart.reduce((sum, item) => sum + item.price, 0);
 
-  // Search customers for credit mode
+  // Search customers for credit mode (typeahead: only id, name and balance per match)
   const searchCustomers = async (search) => {
     setCustomerSearch(search);
+    latestCustomerSearch.current = search;
     if (search.length < 2) {
       setCustomerResults([]);
       return;
@@ -343,12 +348,13 @@ export default function MainPage() {
 
     try {
       setIsSearchingCustomers(true);
-      const results = await api.getCustomers(search);
-      setCustomerResults(results);
+      const results = await api.searchCustomers(search, 5);
+      // Answers can arrive out of order while typing; keep only the latest
+      if (latestCustomerSearch.current === search) setCustomerResults(results);
     } catch (error) {
       console.error('Error searching customers:', error);
     } finally {
-      setIsSearchingCustomers(false);
+      if (latestCustomerSearch.current === search) setIsSearchingCustomers(false);
     }
   };
 
@@ -380,7 +386,7 @@ export default function MainPage() {
         : await api.createPurchase(items);
 
       if (creditEnabled && selectedCustomer) {
-        toast.success(`${cartTotal.toFixed(2)} CHF auf Konto von ${selectedCustomer.first_name} ${selectedCustomer.last_name} gutgeschrieben!`);
+        toast.success(`${cartTotal.toFixed(2)} CHF auf Konto von ${selectedCustomer.name} gutgeschrieben!`);
       } else {
         toast.success('Ankauf gespeichert!');
       }
@@ -521,7 +527,7 @@ export default function MainPage() {
                       </div>
                       <div>
                         <p className="font-medium text-sm text-green-800">
-                          {selectedCustomer.first_name} {selectedCustomer.last_name}
+                          {selectedCustomer.name}
                         </p>
                         <p className="text-xs text-green-600">
                           Guthaben: {selectedCustomer.current_balance?.toFixed(2) || '0.00'} CHF
@@ -553,7 +559,7 @@ export default function MainPage() {
                     )}
                     {customerResults.length > 0 && (
                       <div className="max-h-32 overflow-y-auto space-y-1">
-                        {customerResults.slice(0, 5).map(c => (
+                        {customerResults.map(c => (
                           <div
                             key={c.id}
                             className="flex items-center justify-between p-2 hover:bg-muted rounded cursor-pointer"
@@ -563,7 +569,7 @@ export default function MainPage() {
                               setCustomerResults([]);
                             }}
                           >
-                            <span className="text-sm">{c.first_name} {c.last_name}</span>
+                            <span className="text-sm">{c.name}</span>
                             <span className="text-xs text-muted-foreground">{c.current_balance?.toFixed(2)} CHF</span>
                           </div>
                         ))}